@@ -1,8 +1,13 @@
-import io
+import asyncio
+import hashlib
+import json
 import re
-import requests
+import threading
+import httpx
+from collections import OrderedDict
+from typing import List, Optional
 
-from fastapi.responses import StreamingResponse
+from fastapi.responses import Response, StreamingResponse
 from dotenv import load_dotenv
 import os
 
@@ -15,6 +20,217 @@ VOICE_ID = os.getenv('VOICE_ID')
 print("VOICE_ID: ",VOICE_ID)
 # 일레븐랩스의 음성 클로닝 엔드포인트
 API_URL = f"https://api.elevenlabs.io/v1/text-to-speech/{VOICE_ID}"
+# 생성되는 대로 오디오 청크를 받는 스트리밍 엔드포인트
+STREAM_API_URL = f"{API_URL}/stream"
+
+# 일레븐랩스 호출 타임아웃(초)과 커넥션 풀 크기
+TTS_CONNECT_TIMEOUT = float(os.getenv("TTS_CONNECT_TIMEOUT", "5"))
+TTS_READ_TIMEOUT = float(os.getenv("TTS_READ_TIMEOUT", "30"))
+TTS_MAX_CONNECTIONS = int(os.getenv("TTS_MAX_CONNECTIONS", "20"))
+
+# 문장 단위 분할 합성: 동시에 합성할 최대 문장 수와, 너무 짧은 문장을 다음 문장과 합칠 기준 글자 수
+TTS_CHUNK_CONCURRENCY = int(os.getenv("TTS_CHUNK_CONCURRENCY", "3"))
+TTS_MIN_SEGMENT_CHARS = int(os.getenv("TTS_MIN_SEGMENT_CHARS", "10"))
+
+# 생성한 음성 캐시 (메모리 LRU + 용량 제한 디스크)
+TTS_CACHE_MEMORY_BYTES = int(os.getenv("TTS_CACHE_MEMORY_BYTES", str(64 * 1024 * 1024)))
+TTS_CACHE_DIR = os.getenv("TTS_CACHE_DIR", "tts_cache")
+TTS_CACHE_DISK_BYTES = int(os.getenv("TTS_CACHE_DISK_BYTES", str(1024 * 1024 * 1024)))
+
+# 디스크 용량을 넘었을 때 정리(폴더 전체 조회)는 이 횟수만큼 저장할 때마다 한 번만 실행
+TTS_CACHE_EVICT_EVERY = int(os.getenv("TTS_CACHE_EVICT_EVERY", "50"))
+
+class AudioCache:
+    def __init__(self, memory_bytes=TTS_CACHE_MEMORY_BYTES, cache_dir=TTS_CACHE_DIR, disk_bytes=TTS_CACHE_DISK_BYTES):
+        """
+        음성 캐시 초기화
+        :param memory_bytes: 메모리 LRU 최대 크기 (0 이면 메모리 캐시 사용 안 함)
+        :param cache_dir: 디스크 캐시 폴더
+        :param disk_bytes: 디스크 캐시 최대 크기 (0 이면 디스크 캐시 사용 안 함)
+        """
+        self.memory_bytes = memory_bytes
+        self.cache_dir = cache_dir
+        self.disk_bytes = disk_bytes
+
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        self._disk_size = 0
+
+        # 디스크 쓰기/정리는 스레드에서 실행되므로 디스크 상태는 락으로 보호
+        self._disk_lock = threading.Lock()
+        self._puts_since_evict = 0
+        self._evicting = False
+        self._tasks = set()
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if self.disk_bytes:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self._disk_size = sum(
+                os.path.getsize(os.path.join(self.cache_dir, name))
+                for name in os.listdir(self.cache_dir) if name.endswith(".mp3")
+            )
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.mp3")
+
+    async def get(self, key: str) -> Optional[bytes]:
+        data = self._memory.get(key)
+        if data is not None:
+            self._memory.move_to_end(key)
+            self.memory_hits += 1
+            return data
+
+        if self.disk_bytes:
+            # 파일 읽기는 이벤트 루프를 막지 않도록 스레드에서 실행
+            data = await asyncio.to_thread(self._read_disk, key)
+            if data is not None:
+                self.disk_hits += 1
+                self._put_memory(key, data)
+                return data
+
+        self.misses += 1
+        return None
+
+    def _read_disk(self, key: str) -> Optional[bytes]:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)  # 디스크 LRU 를 위해 수정 시각 갱신
+        except FileNotFoundError:
+            return None
+        return data
+
+    def put(self, key: str, data: bytes):
+        self._put_memory(key, data)
+        if self.disk_bytes and len(data) <= self.disk_bytes:
+            # 디스크 저장과 정리는 응답을 기다리게 하지 않도록 백그라운드 스레드에서 실행
+            task = asyncio.create_task(asyncio.to_thread(self._put_disk, key, data))
+            self._tasks.add(task)
+            task.add_done_callback(self._disk_task_done)
+
+    def _disk_task_done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"음성 캐시 디스크 저장 실패: {task.exception()}")
+
+    async def aclose(self):
+        # 종료 시 진행 중인 디스크 저장을 기다림
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def _put_memory(self, key: str, data: bytes):
+        if not self.memory_bytes or len(data) > self.memory_bytes:
+            return
+        if key in self._memory:
+            self._memory_size -= len(self._memory.pop(key))
+        self._memory[key] = data
+        self._memory_size += len(data)
+        while self._memory_size > self.memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_size -= len(evicted)
+
+    def _put_disk(self, key: str, data: bytes):
+        path = self._path(key)
+        if os.path.exists(path):
+            return
+        tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        with self._disk_lock:
+            self._disk_size += len(data)
+            self._puts_since_evict += 1
+            # 용량을 넘어도 N 번 저장마다 한 번만 정리 (그 사이에는 용량을 조금 넘을 수 있음)
+            evict = (
+                self._disk_size > self.disk_bytes
+                and self._puts_since_evict >= TTS_CACHE_EVICT_EVERY
+                and not self._evicting
+            )
+            if evict:
+                self._evicting = True
+                self._puts_since_evict = 0
+        if evict:
+            try:
+                self._evict_disk()
+            finally:
+                with self._disk_lock:
+                    self._evicting = False
+
+    def _evict_disk(self):
+        # 오래 사용하지 않은 파일부터 용량의 90% 이하가 될 때까지 삭제
+        files = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".mp3"):
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        files.sort()
+
+        total = sum(size for _, size, _ in files)
+        target = self.disk_bytes * 0.9
+        removed = 0
+        for _, size, path in files:
+            if total - removed <= target:
+                break
+            try:
+                os.remove(path)
+                removed += size
+            except FileNotFoundError:
+                pass
+        with self._disk_lock:
+            self._disk_size = total - removed
+
+    def stats(self) -> dict:
+        hits = self.memory_hits + self.disk_hits
+        total = hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round(hits / total, 4) if total else 0.0,
+            "memory_bytes": self._memory_size,
+            "disk_bytes": self._disk_size,
+        }
+
+def audio_response(data: bytes, etag: str, range_header: Optional[str] = None, if_none_match: Optional[str] = None) -> Response:
+    """
+    캐시된 음성 응답 (ETag / Range 지원)
+    :param data: mp3 데이터
+    :param etag: 캐시 키로 만든 ETag
+    :param range_header: 요청의 Range 헤더 (예: bytes=0-1023)
+    :param if_none_match: 요청의 If-None-Match 헤더
+    """
+    headers = {"ETag": etag, "Accept-Ranges": "bytes", "Cache-Control": "private, max-age=86400"}
+
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+
+    size = len(data)
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", range_header.strip()) if range_header else None
+    if range_header and match and (match.group(1) or match.group(2)):
+        if match.group(1):
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+        else:
+            # bytes=-N : 마지막 N 바이트
+            start = max(size - int(match.group(2)), 0)
+            end = size - 1
+
+        if start >= size or start > end:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        return Response(content=data[start:end + 1], status_code=206, media_type="audio/mpeg", headers=headers)
+
+    return Response(content=data, media_type="audio/mpeg", headers=headers)
 
 class TTS:
     def __init__(self, language="ko", voice_id=""):
@@ -25,6 +241,23 @@ class TTS:
         """
         self.language = language
         self.voice_id = voice_id
+        self.cache = AudioCache()
+        self._client = None
+
+    def get_client(self) -> httpx.AsyncClient:
+        # 요청마다 연결을 새로 맺지 않도록 커넥션 풀을 가진 클라이언트를 재사용
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(TTS_READ_TIMEOUT, connect=TTS_CONNECT_TIMEOUT),
+                limits=httpx.Limits(max_connections=TTS_MAX_CONNECTIONS, max_keepalive_connections=TTS_MAX_CONNECTIONS)
+            )
+        return self._client
+
+    async def aclose(self):
+        await self.cache.aclose()
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
 
     def preprocess_text(self, text: str) -> str:
         """
@@ -36,25 +269,12 @@ class TTS:
         text = re.sub(r"[^\w\sㄱ-ㅎㅏ-ㅣ가-힣,.!?]", "", text)
         return text
 
-    def generate_audio(self, text: str):
+    def build_request_data(self, clean_text: str) -> dict:
         """
-        텍스트를 음성으로 변환
-        :param text: 변환할 텍스트
-        :return: StreamingResponse로 반환할 메모리 버퍼
+        일레븐랩스 API 요청 데이터
+        :param clean_text: 전처리된 텍스트
         """
-        if not text:
-            raise ValueError("텍스트가 비어 있습니다.")
-        
-        # 텍스트 전처리
-        clean_text = self.preprocess_text(text)
-        
-        # 일레븐랩스 API에 요청을 보내기 위한 데이터 준비
-        headers = {
-            "xi-api-key": API_KEY,
-        }
-        
-        # 요청 데이터
-        data = {
+        return {
             "text": clean_text,
             "model_id": "eleven_multilingual_v2",
             "voice_id": self.voice_id,  # 사용할 음성 ID
@@ -68,16 +288,183 @@ class TTS:
                 "style":1
                 }  
         }
+
+    def split_sentences(self, clean_text: str) -> List[str]:
+        """
+        전처리된 텍스트를 문장 단위로 분할 (문장부호 또는 줄바꿈 기준)
+        짧은 문장(인사, 이름 접두어 등)은 다음 문장과 합쳐서 요청 수를 줄임
+        :param clean_text: 전처리된 텍스트
+        :return: 문장 리스트
+        """
+        sentences = [s.strip() for s in re.split(r"(?<=[.!?])\s+|\n+", clean_text) if s.strip()]
+
+        segments = []
+        buffer = ""
+        for sentence in sentences:
+            buffer = f"{buffer} {sentence}" if buffer else sentence
+            if len(buffer) >= TTS_MIN_SEGMENT_CHARS:
+                segments.append(buffer)
+                buffer = ""
+        if buffer:
+            if segments:
+                segments[-1] = f"{segments[-1]} {buffer}"
+            else:
+                segments.append(buffer)
+        return segments
+
+    def take_segment(self, buffer: str, final: bool = False):
+        """
+        LLM 이 생성 중인 텍스트에서 바로 합성할 수 있는 완성된 문장들을 잘라냄
+        :param buffer: 아직 합성하지 않은 텍스트
+        :param final: 생성이 끝났으면 True (남은 텍스트를 모두 반환)
+        :return: (전처리된 문장 또는 None, 남은 텍스트)
+        """
+        if final:
+            clean_text = " ".join(self.preprocess_text(buffer).split())
+            return (clean_text or None), ""
+
+        boundaries = list(re.finditer(r"[.!?]+\s+|\n+", buffer))
+        if not boundaries:
+            return None, buffer
+
+        end = boundaries[-1].end()
+        clean_text = " ".join(self.preprocess_text(buffer[:end]).split())
+        if len(clean_text) < TTS_MIN_SEGMENT_CHARS:
+            return None, buffer
+        return clean_text, buffer[end:]
+
+    def cache_key(self, clean_text: str) -> str:
+        """
+        음성 캐시 키: 전처리된 텍스트, 보이스, 모델, 억양 설정이 같으면 같은 키
+        :param clean_text: 전처리된 텍스트
+        """
+        payload = {"voice": VOICE_ID, **self.build_request_data(clean_text)}
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    async def open_stream(self, clean_text: str) -> httpx.Response:
+        """
+        일레븐랩스 스트리밍 엔드포인트 호출 (본문은 아직 읽지 않은 상태로 반환)
+        :param clean_text: 전처리된 텍스트
+        :return: 스트리밍 응답, 다 읽은 뒤 aclose() 필요
+        """
+        # 일레븐랩스 API에 요청을 보내기 위한 데이터 준비
+        headers = {
+            "xi-api-key": API_KEY,
+        }
+
+        client = self.get_client()
+        request = client.build_request("POST", STREAM_API_URL, headers=headers, json=self.build_request_data(clean_text))
+        response = await client.send(request, stream=True)
+
+        if response.status_code != 200:
+            body = await response.aread()
+            await response.aclose()
+            raise Exception(f"음성 생성 실패: {body.decode('utf-8', errors='ignore')}")
+
+        return response
+
+    async def synthesize(self, clean_text: str) -> bytes:
+        """
+        전처리된 텍스트 전체를 합성해서 mp3 데이터로 반환 (캐시 사용)
+        :param clean_text: 전처리된 텍스트
+        """
+        key = self.cache_key(clean_text)
+        cached = await self.cache.get(key)
+        if cached is not None:
+            return cached
+
+        response = await self.open_stream(clean_text)
+        try:
+            data = await response.aread()
+        finally:
+            await response.aclose()
+
+        self.cache.put(key, data)
+        return data
+
+    async def generate_audio_chunked(self, text: str):
+        """
+        텍스트를 문장 단위로 나눠 동시에 합성하고, 문장 순서대로 이어서 스트리밍
+        첫 문장이 합성되면 바로 재생을 시작할 수 있다.
+        :param text: 변환할 텍스트
+        :return: StreamingResponse
+        """
+        if not text:
+            raise ValueError("텍스트가 비어 있습니다.")
+
+        segments = self.split_sentences(self.preprocess_text(text))
+        if not segments:
+            raise ValueError("음성으로 변환할 텍스트가 없습니다.")
+
+        semaphore = asyncio.Semaphore(TTS_CHUNK_CONCURRENCY)
+
+        async def synthesize_segment(segment: str) -> bytes:
+            async with semaphore:
+                return await self.synthesize(segment)
+
+        tasks = [asyncio.create_task(synthesize_segment(segment)) for segment in segments]
+
+        # 첫 문장은 응답 전에 기다려서, 실패하면 500 으로 돌려줄 수 있도록 함
+        try:
+            first = await tasks[0]
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+
+        async def relay():
+            try:
+                yield first
+                for task in tasks[1:]:
+                    yield await task
+            except Exception as e:
+                # 일부만 보낸 음성이 정상 응답처럼 끝나지 않도록 예외를 그대로 올려서 응답을 중단
+                print(f"문장 단위 음성 생성 실패, 응답을 중단합니다: {e}")
+                raise
+            finally:
+                # 클라이언트 연결이 끊기면 남은 합성 요청을 취소
+                for task in tasks:
+                    task.cancel()
+
+        return StreamingResponse(relay(), media_type="audio/mpeg")
+
+    async def generate_audio(self, text: str, range_header: Optional[str] = None, if_none_match: Optional[str] = None):
+        """
+        텍스트를 음성으로 변환
+        :param text: 변환할 텍스트
+        :param range_header: 요청의 Range 헤더 (캐시된 음성에만 적용)
+        :param if_none_match: 요청의 If-None-Match 헤더
+        :return: 캐시된 음성이면 Response, 아니면 일레븐랩스에서 받는 오디오 청크를 그대로 흘려보내는 StreamingResponse
+        """
+        if not text:
+            raise ValueError("텍스트가 비어 있습니다.")
         
-        # 일레븐랩스 API 호출
-        response = requests.post(API_URL.format(voice_id=self.voice_id), headers=headers, json=data)
-        
-        if response.status_code == 200:
-            audio_content = response.content
-            audio_file = io.BytesIO(audio_content)
-            audio_file.seek(0)
+        # 텍스트 전처리
+        clean_text = self.preprocess_text(text)
 
-            # StreamingResponse로 반환
-            return StreamingResponse(audio_file, media_type="audio/mpeg")
-        else:
-            raise Exception(f"음성 생성 실패: {response.text}")
\ No newline at end of file
+        key = self.cache_key(clean_text)
+        etag = f'"{key[:32]}"'
+
+        cached = await self.cache.get(key)
+        if cached is not None:
+            return audio_response(cached, etag, range_header, if_none_match)
+
+        # 응답 상태는 스트리밍 시작 전에 확인해서, 실패하면 500 으로 돌려줄 수 있도록 함
+        response = await self.open_stream(clean_text)
+
+        async def relay():
+            chunks = []
+            completed = False
+            try:
+                async for chunk in response.aiter_bytes():
+                    chunks.append(chunk)
+                    yield chunk
+                completed = True
+            finally:
+                # 클라이언트 연결이 끊겨 취소되어도 업스트림 연결을 닫음
+                await response.aclose()
+                # 끝까지 받은 음성만 캐시에 저장
+                if completed:
+                    self.cache.put(key, b"".join(chunks))
+
+        return StreamingResponse(relay(), media_type="audio/mpeg", headers={"ETag": etag})
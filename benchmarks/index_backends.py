@@ -0,0 +1,191 @@
+"""
+인덱스 종류(flat / ivf / hnsw)와 저장 방식(float32 / fp16 / sq8 / pq)별 메모리, 생성 시간, recall 비교
+기준은 지금 쓰는 캐릭터별 flat(float32) 인덱스의 정확한 검색 결과이다.
+
+- 인덱스 크기: 인덱스 파일 크기 (mmap 없이 열면 이만큼 메모리에 올라감)
+- mmap RSS: 파일을 mmap 으로 열고 질문을 모두 검색한 뒤 늘어난 메모리 (실제로 읽힌 페이지)
+- layout=character 는 캐릭터마다 인덱스 하나, layout=shared 는 인덱스 하나에 캐릭터별 id 범위로 검색
+
+index_store 에 저장된 캐릭터 청크를 쓰거나(임베딩 캐시 사용), --synthetic 으로 임의 벡터를 만들어
+캐릭터가 수백 명일 때를 API 호출 없이 측정할 수 있다.
+
+사용 예:
+    python benchmarks/index_backends.py --character-id 1 2 3 4 5 6
+    python benchmarks/index_backends.py --synthetic 300 --chunks-per-character 500 --configs flat:float32 hnsw:fp16 ivf:pq
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import faiss
+import numpy as np
+
+from index_store import build_faiss_index, latest_index_key, load_index, search_parameters
+
+DEFAULT_CONFIGS = ["flat:float32", "flat:fp16", "flat:pq", "ivf:float32", "ivf:pq", "hnsw:float32", "hnsw:fp16"]
+
+
+def rss_mb():
+    # 리눅스에서만 측정 (/proc 없으면 None)
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+
+
+def character_vectors(character_ids):
+    from langchain_openai import OpenAIEmbeddings
+    from embedding_cache import CachedEmbeddings
+
+    embeddings = CachedEmbeddings(OpenAIEmbeddings())
+    groups = {}
+    for character_id in character_ids:
+        key = latest_index_key(character_id)
+        stored = load_index(character_id, key, embeddings) if key else None
+        if stored is None:
+            print(f"캐릭터 {character_id} 의 저장된 인덱스가 없어서 제외합니다.")
+            continue
+        # 인덱스를 만들 때 캐시된 임베딩을 그대로 사용
+        groups[character_id] = np.array(embeddings.embed_documents([c.page_content for c in stored[1]]), dtype=np.float32)
+    return groups
+
+
+def synthetic_vectors(characters: int, per_character: int, dim: int, seed: int):
+    # 캐릭터마다 중심이 다른 정규화 벡터 (같은 캐릭터 청크끼리 가까움)
+    rng = np.random.default_rng(seed)
+    groups = {}
+    for character_id in range(1, characters + 1):
+        center = rng.standard_normal(dim)
+        vectors = center + rng.standard_normal((per_character, dim)) * 1.5
+        groups[character_id] = (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+    return groups
+
+
+def make_queries(groups, count: int, seed: int):
+    # 청크 벡터에 잡음을 더해 질문으로 사용 (character_id, 벡터)
+    rng = np.random.default_rng(seed)
+    character_ids = list(groups)
+    queries = []
+    for _ in range(count):
+        character_id = character_ids[rng.integers(len(character_ids))]
+        vectors = groups[character_id]
+        vector = vectors[rng.integers(len(vectors))] + rng.standard_normal(vectors.shape[1]).astype(np.float32) * 0.05
+        queries.append((character_id, (vector / np.linalg.norm(vector)).astype(np.float32)))
+    return queries
+
+
+def ground_truth(groups, queries, k: int):
+    exact = {character_id: faiss.IndexFlatL2(vectors.shape[1]) for character_id, vectors in groups.items()}
+    for character_id, index in exact.items():
+        index.add(groups[character_id])
+    return [set(exact[character_id].search(vector[None, :], k)[1][0]) for character_id, vector in queries]
+
+
+def _write_and_mmap(indexes, directory: str):
+    # 파일로 저장한 뒤 mmap 으로 다시 열기 (서비스에서 load_index 하는 것과 같음)
+    flag = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP)
+    size = 0
+    opened = {}
+    for name, index in indexes.items():
+        path = os.path.join(directory, f"{name}.faiss")
+        faiss.write_index(index, path)
+        size += os.path.getsize(path)
+        opened[name] = faiss.read_index(path, flag)
+        # 검색 파라미터는 파일에 저장되지 않으므로 다시 설정
+        ivf = faiss.try_extract_index_ivf(index)
+        if ivf is not None:
+            faiss.extract_index_ivf(opened[name]).nprobe = ivf.nprobe
+        if isinstance(index, faiss.IndexHNSW):
+            opened[name].hnsw.efSearch = index.hnsw.efSearch
+    return opened, size
+
+
+def run_config(config: str, layout: str, groups, queries, truth, k: int):
+    backend, storage = config.split(":")
+
+    started = time.perf_counter()
+    if layout == "shared":
+        character_ids = sorted(groups)
+        ranges, offset = {}, 0
+        for character_id in character_ids:
+            ranges[character_id] = (offset, offset + len(groups[character_id]))
+            offset += len(groups[character_id])
+        indexes = {"shared": build_faiss_index(np.concatenate([groups[c] for c in character_ids]), backend, storage)}
+    else:
+        indexes = {character_id: build_faiss_index(vectors, backend, storage) for character_id, vectors in groups.items()}
+    build_seconds = time.perf_counter() - started
+
+    with tempfile.TemporaryDirectory() as directory:
+        rss_before = rss_mb()
+        opened, size = _write_and_mmap(indexes, directory)
+        del indexes
+
+        if layout == "shared":
+            index = opened["shared"]
+            params = {c: search_parameters(index, faiss.IDSelectorRange(*ranges[c])) for c in ranges}
+
+        latencies = []
+        hits = 0
+        for (character_id, vector), expected in zip(queries, truth):
+            started = time.perf_counter()
+            if layout == "shared":
+                start = ranges[character_id][0]
+                found = index.search(vector[None, :], k, params=params[character_id])[1][0]
+                found = {i - start for i in found if i != -1}
+            else:
+                found = {i for i in opened[character_id].search(vector[None, :], k)[1][0] if i != -1}
+            latencies.append(time.perf_counter() - started)
+            hits += len(found & expected)
+        rss_after = rss_mb()
+        del opened
+
+    latencies.sort()
+    p95 = latencies[max(0, int(len(latencies) * 0.95) - 1)]
+    mmap_rss = f"{rss_after - rss_before:8.1f}MB" if rss_before is not None else "       -"
+    print(
+        f"{layout:<9} {config:<13} build={build_seconds:7.2f}s  size={size / 2 ** 20:8.1f}MB  mmap_rss={mmap_rss}  "
+        f"recall@{k}={hits / (len(queries) * k):.3f}  p50={statistics.median(latencies) * 1000:6.3f}ms  p95={p95 * 1000:6.3f}ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="인덱스 종류/저장 방식별 메모리, 생성 시간, recall 비교")
+    parser.add_argument("--character-id", type=int, nargs="+", default=[1, 2, 3, 4, 5, 6], help="index_store 에 저장된 캐릭터")
+    parser.add_argument("--synthetic", type=int, default=0, help="임의 벡터로 만들 캐릭터 수 (지정하면 저장된 인덱스 대신 사용)")
+    parser.add_argument("--chunks-per-character", type=int, default=300)
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--configs", nargs="+", default=DEFAULT_CONFIGS, help="backend:storage 목록")
+    parser.add_argument("--layouts", nargs="+", default=["character", "shared"])
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--count", type=int, default=200, help="질문 수")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.synthetic:
+        groups = synthetic_vectors(args.synthetic, args.chunks_per_character, args.dim, args.seed)
+    else:
+        groups = character_vectors(args.character_id)
+    if not groups:
+        print("비교할 벡터가 없습니다. 서버를 한 번 실행해서 인덱스를 만들거나 --synthetic 을 사용해 주세요.")
+        return
+
+    total = sum(len(vectors) for vectors in groups.values())
+    print(f"characters={len(groups)}  vectors={total}  dim={next(iter(groups.values())).shape[1]}")
+
+    queries = make_queries(groups, args.count, args.seed)
+    truth = ground_truth(groups, queries, args.k)
+    for layout in args.layouts:
+        for config in args.configs:
+            run_config(config, layout, groups, queries, truth, args.k)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+/chat 동시 요청 부하 테스트
+동시 요청 수를 늘려가며 처리량(req/s)과 지연시간(p50/p95)을 측정한다.
+
+사용 예:
+    python benchmarks/load_test.py --url http://localhost:8000 --character-id 6 --concurrency 1 4 16 64
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+import httpx
+
+
+async def run_level(client: httpx.AsyncClient, args, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async def one(i: int):
+        nonlocal errors
+        payload = {
+            "user_id": args.user_id,
+            # 대화마다 다른 conversation_id 를 써서 히스토리가 섞이지 않도록 함
+            "conversation_id": args.conversation_base + concurrency * 100000 + i,
+            "question": args.question,
+            "character_id": args.character_id,
+        }
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                response = await client.post(f"{args.url}{args.path}", json=payload)
+                response.raise_for_status()
+                latencies.append(time.perf_counter() - started)
+            except Exception as e:
+                errors += 1
+                print(f"요청 실패: {e}")
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(args.requests)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    p95 = latencies[int(len(latencies) * 0.95) - 1] if latencies else 0.0
+    print(
+        f"concurrency={concurrency:<4} ok={len(latencies):<5} errors={errors:<4} "
+        f"throughput={len(latencies) / elapsed:7.2f} req/s  "
+        f"p50={statistics.median(latencies) if latencies else 0.0:6.2f}s  p95={p95:6.2f}s"
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="/chat 부하 테스트")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--path", default="/chat")
+    parser.add_argument("--character-id", type=int, default=6)
+    parser.add_argument("--user-id", type=int, default=1)
+    parser.add_argument("--conversation-base", type=int, default=900000000)
+    parser.add_argument("--question", default="넌 누구야?")
+    parser.add_argument("--requests", type=int, default=64, help="동시성 단계별 요청 수")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--timeout", type=float, default=120.0)
+    args = parser.parse_args()
+
+    limits = httpx.Limits(max_connections=max(args.concurrency), max_keepalive_connections=max(args.concurrency))
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+        for concurrency in args.concurrency:
+            await run_level(client, args, concurrency)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,106 @@
+"""
+검색 방식(vector / lexical / hybrid)별 지연시간과 recall 비교
+index_store 에 저장된 캐릭터 인덱스와 청크(chunks.json)를 그대로 사용한다.
+
+질문 파일이 없으면 청크에서 문장 일부를 잘라 질문으로 쓰고, 그 청크를 정답으로 본다.
+(이 방식은 단어가 그대로 겹쳐서 lexical 쪽에 유리하므로, 실제 비교에는 --queries 파일을 권장)
+
+질문 파일 형식 (JSON Lines):
+    {"question": "게살버거 비밀 레시피는 어디 있어?", "answer": "정답 청크에 들어 있는 문구"}
+
+사용 예:
+    python benchmarks/retrieval_modes.py --character-id 6 --k 4
+    python benchmarks/retrieval_modes.py --character-id 6 --queries data/retrieval_eval_6.jsonl
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain_openai import OpenAIEmbeddings
+
+from embedding_cache import CachedEmbeddings
+from hybrid_retriever import BM25Index, HybridRetriever
+from index_store import latest_index_key, load_index
+
+
+def synthetic_queries(chunks, count: int, seed: int):
+    rng = random.Random(seed)
+    candidates = [c for c in chunks if len(c.page_content.strip()) >= 40]
+    queries = []
+    for chunk in rng.sample(candidates, min(count, len(candidates))):
+        text = chunk.page_content.strip()
+        start = rng.randrange(0, len(text) - 30)
+        queries.append({"question": text[start:start + 30], "answer": text[start:start + 30]})
+    return queries
+
+
+def load_queries(path: str):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def run_mode(mode: str, vectorstore, lexical_index, queries, k: int):
+    retriever = HybridRetriever(vectorstore=vectorstore, lexical_index=lexical_index, mode=mode, search_kwargs={"k": k})
+
+    # 질문 임베딩 시간까지 포함해서 측정 (서비스에서 retriever.invoke 를 부르는 것과 같음)
+    latencies = []
+    hits = 0
+    for query in queries:
+        started = time.perf_counter()
+        docs = retriever.invoke(query["question"])
+        latencies.append(time.perf_counter() - started)
+        if any(query["answer"] in doc.page_content for doc in docs):
+            hits += 1
+
+    latencies.sort()
+    p95 = latencies[max(0, int(len(latencies) * 0.95) - 1)]
+    print(
+        f"mode={mode:<8} recall@{k}={hits / len(queries):.3f}  "
+        f"p50={statistics.median(latencies) * 1000:8.2f}ms  p95={p95 * 1000:8.2f}ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="검색 방식별 지연시간/recall 비교")
+    parser.add_argument("--character-id", type=int, required=True)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--queries", help="질문 파일 (JSON Lines), 없으면 청크에서 자동 생성")
+    parser.add_argument("--count", type=int, default=100, help="자동 생성할 질문 수")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-embedding-cache", action="store_true", help="질문마다 실제 임베딩 API 호출 (네트워크 지연 포함, 기본은 미리 캐시해 둠)")
+    parser.add_argument("--modes", nargs="+", default=["vector", "lexical", "hybrid"])
+    args = parser.parse_args()
+
+    embeddings = OpenAIEmbeddings() if args.no_embedding_cache else CachedEmbeddings(OpenAIEmbeddings())
+
+    key = latest_index_key(args.character_id)
+    stored = load_index(args.character_id, key, embeddings) if key else None
+    if stored is None:
+        print(f"캐릭터 {args.character_id} 의 저장된 인덱스가 없습니다. 서버를 한 번 실행해서 인덱스를 만들어 주세요.")
+        return
+    vectorstore, chunks = stored
+
+    started = time.perf_counter()
+    lexical_index = BM25Index(chunks)
+    print(f"chunks={len(chunks)}  bm25_build={(time.perf_counter() - started) * 1000:.1f}ms")
+
+    queries = load_queries(args.queries) if args.queries else synthetic_queries(chunks, args.count, args.seed)
+    print(f"queries={len(queries)} ({'file' if args.queries else 'synthetic'})")
+
+    if not args.no_embedding_cache:
+        # 모든 모드가 같은 조건(캐시 적중)에서 측정되도록 질문 임베딩을 미리 채움 (질문 임베딩은 메모리 캐시)
+        for query in queries:
+            embeddings.embed_query(query["question"])
+
+    for mode in args.modes:
+        run_mode(mode, vectorstore, lexical_index, queries, args.k)
+
+
+if __name__ == "__main__":
+    main()
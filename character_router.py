@@ -0,0 +1,218 @@
+import os
+import re
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from langchain_openai import ChatOpenAI
+
+from chat_logic import embeddings, CHARACTER_RETRIEVERS, CHARACTER_DESCRIPTIONS, setup_character_matching_prompt
+
+# 라우팅 방식 (hybrid: 임베딩 점수가 애매할 때만 LLM 호출 | local: LLM 호출 안 함 | llm: 항상 LLM 사용)
+ROUTER_MODE = os.getenv("ROUTER_MODE", "hybrid").lower()
+
+# 캐릭터 설명 유사도와 지식 베이스 유사도의 가중치 (0 이면 설명만 사용)
+ROUTER_KB_WEIGHT = float(os.getenv("ROUTER_KB_WEIGHT", "0.5"))
+
+# 지식 베이스 유사도를 청크 중심(centroid) 대신 리트리버의 가장 가까운 청크로 계산할지 여부
+ROUTER_USE_RETRIEVER = os.getenv("ROUTER_USE_RETRIEVER", "false").lower() == "true"
+
+# 1등 점수와 이 차이 이내인 캐릭터는 함께 선택
+ROUTER_SELECT_BAND = float(os.getenv("ROUTER_SELECT_BAND", "0.02"))
+ROUTER_MAX_CHARACTERS = int(os.getenv("ROUTER_MAX_CHARACTERS", "2"))
+
+# 1등 점수가 이보다 낮거나, 선택된 캐릭터와 나머지의 점수 차이(confidence)가 이보다 작으면 LLM 으로 판단
+ROUTER_MIN_SCORE = float(os.getenv("ROUTER_MIN_SCORE", "0.25"))
+ROUTER_MIN_CONFIDENCE = float(os.getenv("ROUTER_MIN_CONFIDENCE", "0.03"))
+
+# "스폰지밥 (SpongeBob SquarePants) - ..." 에서 한글/영문 이름 추출
+_NAME_PATTERN = re.compile(r"^(\S+)\s*\(([^)]+)\)")
+
+
+def _normalize(vector) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def _character_names(character_id: int) -> List[str]:
+    match = _NAME_PATTERN.match(CHARACTER_DESCRIPTIONS.get(character_id, ""))
+    if match is None:
+        return []
+    korean, english = match.groups()
+    return [korean, english, english.split()[0]]
+
+
+class CharacterRouter:
+    """
+    단체방 질문에 답할 캐릭터를 임베딩 유사도로 고르고, 점수가 애매할 때만 LLM 으로 판단
+    """
+
+    def __init__(self):
+        self._description_vectors: Dict[int, np.ndarray] = {}
+        self._kb_centroids: Dict[int, Tuple[int, Optional[np.ndarray]]] = {}   # character_id -> (vectorstore id, 중심 벡터)
+        self.counts = {"name": 0, "embedding": 0, "llm": 0}
+        self.confidence_sum = 0.0
+        self.routed = 0
+
+    async def warm(self, character_ids: List[int]):
+        """
+        캐릭터 설명 임베딩을 서버 시작 시 한 번에 계산 (첫 매칭 요청이 임베딩을 기다리지 않도록)
+        """
+        missing = [c for c in character_ids if c in CHARACTER_DESCRIPTIONS and c not in self._description_vectors]
+        if not missing:
+            return
+        try:
+            # 설명 문장은 문서 임베딩 캐시(sqlite)에 저장되어 재시작 후에는 API 호출 없이 채워짐
+            vectors = await embeddings.aembed_documents([CHARACTER_DESCRIPTIONS[c] for c in missing])
+        except Exception as e:
+            print(f"캐릭터 설명 임베딩 미리 계산 실패 (첫 요청 때 계산): {e}")
+            return
+        for character_id, vector in zip(missing, vectors):
+            self._description_vectors[character_id] = _normalize(vector)
+
+    async def _description_vector(self, character_id: int) -> np.ndarray:
+        vector = self._description_vectors.get(character_id)
+        if vector is None:
+            vector = _normalize(await embeddings.aembed_query(CHARACTER_DESCRIPTIONS[character_id]))
+            self._description_vectors[character_id] = vector
+        return vector
+
+    def _kb_centroid(self, character_id: int) -> Optional[np.ndarray]:
+        # 인덱스가 다시 만들어지면 vectorstore 객체가 바뀌므로 그때 다시 계산
+        retriever = CHARACTER_RETRIEVERS.get(character_id)
+        if retriever is None:
+            return None
+        vectorstore = retriever.vectorstore
+        cached = self._kb_centroids.get(character_id)
+        if cached is not None and cached[0] == id(vectorstore):
+            return cached[1]
+
+        centroid = None
+        try:
+            # 공유 인덱스(INDEX_LAYOUT=shared)면 해당 캐릭터의 id 범위만 사용
+            index = vectorstore.index
+            start, end = getattr(vectorstore, "id_range", (0, index.ntotal))
+            if end > start:
+                centroid = _normalize(index.reconstruct_n(start, end - start).mean(axis=0))
+        except Exception as e:
+            print(f"지식 베이스 중심 벡터 계산 실패 (character_id: {character_id}): {e}")
+        self._kb_centroids[character_id] = (id(vectorstore), centroid)
+        return centroid
+
+    def _kb_similarity(self, character_id: int, query_vector: np.ndarray) -> Optional[float]:
+        if ROUTER_USE_RETRIEVER:
+            retriever = CHARACTER_RETRIEVERS.get(character_id)
+            if retriever is None:
+                return None
+            # 질문 임베딩을 재사용해서 추가 임베딩 호출 없이 가장 가까운 청크 검색 (정규화된 벡터의 L2 제곱 거리 -> 코사인)
+            results = retriever.vectorstore.similarity_search_with_score_by_vector(query_vector.tolist(), k=1)
+            if not results:
+                return None
+            return 1.0 - float(results[0][1]) / 2.0
+
+        centroid = self._kb_centroid(character_id)
+        if centroid is None:
+            return None
+        return float(np.dot(query_vector, centroid))
+
+    async def score(self, query_vector: np.ndarray, char_id_list: List[int]) -> Dict[int, float]:
+        """
+        :param query_vector: 정규화된 질문 임베딩
+        :return: character_id -> 질문과의 유사도 점수
+        """
+        scores = {}
+        for char_id in char_id_list:
+            score = float(np.dot(query_vector, await self._description_vector(char_id)))
+            kb_score = self._kb_similarity(char_id, query_vector) if ROUTER_KB_WEIGHT else None
+            if kb_score is not None:
+                score = (1 - ROUTER_KB_WEIGHT) * score + ROUTER_KB_WEIGHT * kb_score
+            scores[char_id] = score
+        return scores
+
+    def _record(self, method: str, confidence: float):
+        self.counts[method] += 1
+        self.routed += 1
+        self.confidence_sum += confidence
+
+    async def route(self, question: str, char_id_list: List[int], chat_history_list: List[str]) -> dict:
+        """
+        :return: {"selected_char_id_list": [...], "confidence": 0~1, "method": "name" | "embedding" | "llm", "scores": {...},
+                  "query_vector": 질문 임베딩 (계산하지 않았으면 None, 단체방 검색에서 재사용)}
+        """
+        char_id_list = [char_id for char_id in char_id_list if char_id in CHARACTER_DESCRIPTIONS]
+        if not char_id_list:
+            return {"selected_char_id_list": [], "confidence": 0.0, "method": "embedding", "scores": {}, "query_vector": None}
+
+        # 질문에 캐릭터 이름이 있으면 그 캐릭터가 답함
+        named = [char_id for char_id in char_id_list
+                 if any(name.lower() in question.lower() for name in _character_names(char_id))]
+        if named and ROUTER_MODE != "llm":
+            self._record("name", 1.0)
+            return {"selected_char_id_list": named, "confidence": 1.0, "method": "name", "scores": {}, "query_vector": None}
+
+        scores = {}
+        selected = []
+        confidence = 0.0
+        query_vector = None
+        if ROUTER_MODE != "llm":
+            query_vector = await embeddings.aembed_query(question)
+            scores = await self.score(_normalize(query_vector), char_id_list)
+            ranked = sorted(scores, key=scores.get, reverse=True)
+            top = scores[ranked[0]]
+            selected = [char_id for char_id in ranked if scores[char_id] >= top - ROUTER_SELECT_BAND][:ROUTER_MAX_CHARACTERS]
+            rest = [scores[char_id] for char_id in ranked if char_id not in selected]
+            # 선택된 캐릭터 중 가장 낮은 점수와 나머지 중 가장 높은 점수의 차이
+            confidence = scores[selected[-1]] - rest[0] if rest else top
+            confidence = max(0.0, min(1.0, confidence))
+
+            ambiguous = top < ROUTER_MIN_SCORE or confidence < ROUTER_MIN_CONFIDENCE
+            if ROUTER_MODE == "local" or not ambiguous:
+                self._record("embedding", confidence)
+                return {"selected_char_id_list": selected, "confidence": confidence, "method": "embedding", "scores": scores, "query_vector": query_vector}
+
+        try:
+            matched = await llm_match(question, char_id_list, chat_history_list)
+        except Exception as e:
+            # LLM 호출이 실패하면 임베딩 결과를 그대로 사용
+            if not selected:
+                raise
+            print(f"LLM 캐릭터 매칭 실패, 임베딩 결과 사용: {e}")
+            matched = []
+
+        # LLM 이 방에 없는 캐릭터를 고를 수 있으므로 방 안의 캐릭터만 남기고, 남는 게 없으면 임베딩 결과 사용
+        matched = [char_id for char_id in dict.fromkeys(matched) if char_id in char_id_list]
+        method = "llm" if matched or not selected else "embedding"
+        selected = matched or selected
+        self._record(method, confidence)
+        return {"selected_char_id_list": selected, "confidence": confidence, "method": method, "scores": scores, "query_vector": query_vector}
+
+    def stats(self) -> dict:
+        return {
+            "mode": ROUTER_MODE,
+            "counts": dict(self.counts),
+            "llm_rate": self.counts["llm"] / self.routed if self.routed else 0.0,
+            "avg_confidence": self.confidence_sum / self.routed if self.routed else 0.0
+        }
+
+
+async def llm_match(question: str, char_id_list: List[int], chat_history_list: List[str]) -> List[int]:
+    """
+    LLM 으로 답할 캐릭터 선택
+    :return: 캐릭터 id 리스트
+    """
+    formatted_chat_history = "\n".join(chat_history_list)
+    formatted_character_info = "\n".join(
+        f"{char_id}: {CHARACTER_DESCRIPTIONS[char_id]}" for char_id in char_id_list
+    )
+
+    prompt = setup_character_matching_prompt()
+    llm = ChatOpenAI(model="gpt-4o-mini", temperature=0.1)
+    result = await llm.ainvoke(
+        prompt.format(question=question, chat_history=formatted_chat_history, character_info=formatted_character_info)
+    )
+
+    numeric_ids = re.findall(r'\b\d+\b', result.content)    # 숫자(정수)만 추출
+    return [int(char_id) for char_id in numeric_ids]
+
+
+character_router = CharacterRouter()
@@ -0,0 +1,479 @@
+import asyncio
+import os
+from datetime import datetime
+from typing import List, Optional, Sequence, Tuple
+
+from langchain_community.chat_message_histories import SQLChatMessageHistory
+from langchain_core.messages import BaseMessage, SystemMessage, get_buffer_string
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_openai import ChatOpenAI
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, Text, insert, select, update
+
+from hot_history import get_hot_store, hot_limit
+from token_count import count_tokens
+
+# 프롬프트에 그대로 넣을 최근 대화 턴 수 (1턴 = 사용자 메세지 + 캐릭터 메세지, 0 이면 제한 없음)
+HISTORY_MAX_TURNS = int(os.getenv("HISTORY_MAX_TURNS", "0"))
+
+# 최근 대화에 쓸 토큰 예산 (0 이면 제한 없음)
+HISTORY_MAX_TOKENS = int(os.getenv("HISTORY_MAX_TOKENS", "0"))
+
+# 토큰 예산만 쓸 때 한 번에 읽을 메세지 수 (예산이 찰 때까지 이 단위로 이전 메세지를 더 읽음)
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "20"))
+
+# 범위를 벗어난 이전 대화를 요약으로 유지할지 여부 (gpt-4o-mini 추가 호출이 생기므로 기본은 꺼짐)
+HISTORY_SUMMARY_ENABLED = os.getenv("HISTORY_SUMMARY_ENABLED", "false").lower() == "true"
+
+# 요약에 새로 합칠 메세지가 이 개수 이상 쌓였을 때만 요약 갱신
+HISTORY_SUMMARY_MIN_MESSAGES = int(os.getenv("HISTORY_SUMMARY_MIN_MESSAGES", "2"))
+
+# write-behind 모드: 응답은 바로 돌려주고 히스토리는 백그라운드에서 모아서 한 번에 저장
+HISTORY_WRITE_BEHIND = os.getenv("HISTORY_WRITE_BEHIND", "false").lower() == "true"
+HISTORY_FLUSH_BATCH_SIZE = int(os.getenv("HISTORY_FLUSH_BATCH_SIZE", "100"))    # 이 개수만큼 쌓이면 바로 저장
+HISTORY_FLUSH_INTERVAL = float(os.getenv("HISTORY_FLUSH_INTERVAL", "0.5"))      # 초, 최대 저장 지연
+HISTORY_FLUSH_MAX_ATTEMPTS = int(os.getenv("HISTORY_FLUSH_MAX_ATTEMPTS", "5"))  # 이 횟수만큼 저장에 실패한 메세지는 버림
+
+# 대화별 요약 (chat_message 와 같은 DB 에 저장)
+summary_metadata = MetaData()
+chat_summary_table = Table(
+    "chat_summary",
+    summary_metadata,
+    Column("session_id", String(64), primary_key=True),
+    Column("summary", Text, nullable=False),
+    Column("last_message_id", Integer, nullable=False),   # 요약에 포함된 마지막 chat_message id
+    Column("updated_at", DateTime, nullable=False),
+)
+
+SUMMARY_PROMPT = ChatPromptTemplate.from_messages(
+    [
+        ("system", """
+        # Task
+        - Progressively summarize a conversation between a user and a character chatbot.
+        - Extend the current summary with the new lines and return only the updated summary.
+
+        # Policy
+        - Write the summary in Korean.
+        - Keep names, promises, preferences and facts the user has shared.
+        - Keep the summary under 10 sentences.
+        """),
+        ("human", "Current summary:\n{summary}\n\nNew lines:\n{new_lines}")
+    ]
+)
+
+_summary_llm = None
+
+# 테이블 생성 확인이 끝난 테이블 (요청마다 CREATE TABLE 확인 쿼리를 보내지 않도록)
+_ready_tables = set()
+
+# 요약 중인 대화 (같은 대화를 동시에 두 번 요약하지 않도록)
+_summarizing = set()
+_background_tasks = set()
+
+
+def get_summary_llm() -> ChatOpenAI:
+    global _summary_llm
+    if _summary_llm is None:
+        _summary_llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)
+    return _summary_llm
+
+
+async def summarize_messages(summary: str, messages: Sequence[BaseMessage]) -> str:
+    new_lines = get_buffer_string(messages, human_prefix="user", ai_prefix="character")
+    result = await get_summary_llm().ainvoke(
+        SUMMARY_PROMPT.format_messages(summary=summary or "(none)", new_lines=new_lines)
+    )
+    return result.content.strip()
+
+
+class _PendingMessage:
+    __slots__ = ("engine", "table", "key", "message", "row", "attempts")
+
+    def __init__(self, engine, table, key, message, row):
+        self.engine = engine
+        self.table = table
+        self.key = key
+        self.message = message
+        self.row = row
+        self.attempts = 0
+
+
+class HistoryWriteBehind:
+    """
+    채팅 히스토리 write-behind 버퍼
+    메세지를 메모리에 모아두었다가 개수/시간 기준으로 여러 행을 한 번에 INSERT 한다.
+    아직 저장되지 않은 메세지도 같은 대화의 다음 턴에서 읽을 수 있다.
+    """
+
+    def __init__(self, batch_size: int = HISTORY_FLUSH_BATCH_SIZE, flush_interval: float = HISTORY_FLUSH_INTERVAL):
+        """
+        :param batch_size: 한 번의 INSERT 에 넣을 최대 메세지 수, 이만큼 쌓이면 바로 저장
+        :param flush_interval: 메세지가 버퍼에 머무는 최대 시간(초)
+        """
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        # 저장 중이면 홀수 (읽는 쪽에서 저장 중인 메세지를 중복으로 읽지 않도록)
+        self.generation = 0
+
+        self.flushes = 0
+        self.flushed_messages = 0
+        self.failures = 0
+        self.dropped = 0
+
+        self._pending: List[_PendingMessage] = []
+        self._task = None
+        self._wakeup = None
+        self._flushed = None
+        self._flush_lock = None
+
+    def _ensure_started(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._flushed = asyncio.Event()
+            self._flushed.set()
+            self._flush_lock = asyncio.Lock()
+            self._task = asyncio.create_task(self._run())
+
+    @staticmethod
+    def _key(history) -> Tuple[str, str]:
+        return (history.sql_model_class.__tablename__, str(history.session_id))
+
+    def enqueue(self, history, messages: Sequence[BaseMessage]):
+        self._ensure_started()
+
+        table = history.sql_model_class.__table__
+        key = self._key(history)
+        for message in messages:
+            record = history.converter.to_sql_model(message, history.session_id)
+            row = {column.name: getattr(record, column.name) for column in table.columns if not column.primary_key}
+            self._pending.append(_PendingMessage(history.async_engine, table, key, message, row))
+
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+    def pending_messages(self, history) -> List[BaseMessage]:
+        key = self._key(history)
+        return [p.message for p in self._pending if p.key == key]
+
+    async def wait_stable(self) -> int:
+        # 진행 중인 저장이 있으면 끝날 때까지 기다린 뒤 현재 generation 반환
+        while self.generation % 2:
+            await self._flushed.wait()
+        return self.generation
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        if not self._pending or self._flush_lock is None:
+            return
+
+        async with self._flush_lock:
+            batch = list(self._pending)
+            if not batch:
+                return
+
+            groups = {}
+            for pending in batch:
+                groups.setdefault((pending.engine, pending.table), []).append(pending)
+
+            self.generation += 1
+            self._flushed.clear()
+            try:
+                for (engine, table), items in groups.items():
+                    for i in range(0, len(items), self.batch_size):
+                        await self._flush_chunk(engine, table, items[i:i + self.batch_size])
+            finally:
+                self.generation += 1
+                self._flushed.set()
+
+    async def _insert(self, engine, table, chunk: List[_PendingMessage]):
+        async with engine.begin() as conn:
+            await conn.execute(insert(table), [p.row for p in chunk])
+
+        # 커밋된 메세지만 버퍼에서 제거
+        committed = set(map(id, chunk))
+        self._pending = [p for p in self._pending if id(p) not in committed]
+        self.flushes += 1
+        self.flushed_messages += len(chunk)
+
+    async def _flush_chunk(self, engine, table, chunk: List[_PendingMessage]):
+        try:
+            await self._insert(engine, table, chunk)
+            return
+        except Exception as e:
+            self.failures += 1
+            print(f"채팅 히스토리 저장 실패, 다음 주기에 재시도합니다: {e}")
+
+        # 잘못된 행 하나 때문에 같은 묶음의 다른 메세지가 막히지 않도록 한 건씩 다시 저장
+        if len(chunk) > 1:
+            for pending in chunk:
+                try:
+                    await self._insert(engine, table, [pending])
+                except Exception:
+                    pass
+
+        # 계속 실패하는 메세지는 횟수 제한을 넘으면 버림 (영구적인 오류로 버퍼가 계속 커지지 않도록)
+        remaining = set(map(id, self._pending))
+        failed = [p for p in chunk if id(p) in remaining]
+        for pending in failed:
+            pending.attempts += 1
+        dropped = {id(p) for p in failed if p.attempts >= HISTORY_FLUSH_MAX_ATTEMPTS}
+        if dropped:
+            self._pending = [p for p in self._pending if id(p) not in dropped]
+            self.dropped += len(dropped)
+            print(f"채팅 히스토리 {len(dropped)}건을 {HISTORY_FLUSH_MAX_ATTEMPTS}번 저장하지 못해 버립니다.")
+
+    async def stop(self):
+        # 종료 시 남은 메세지를 모두 저장
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        await self.flush()
+        self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "enabled": HISTORY_WRITE_BEHIND or get_hot_store() is not None,
+            "pending": len(self._pending),
+            "flushes": self.flushes,
+            "flushed_messages": self.flushed_messages,
+            "failures": self.failures,
+            "dropped": self.dropped,
+        }
+
+
+history_writer = HistoryWriteBehind()
+
+
+class WindowedChatMessageHistory(SQLChatMessageHistory):
+    """
+    최근 N턴(또는 토큰 예산)만 그대로 불러오고, 그 이전 대화는 누적 요약으로 대체하는 히스토리
+    대화가 길어져도 턴마다 읽는 양과 프롬프트 길이가 일정하게 유지된다.
+    """
+
+    def __init__(
+        self,
+        *args,
+        max_turns: int = HISTORY_MAX_TURNS,
+        max_tokens: int = HISTORY_MAX_TOKENS,
+        summarize: bool = HISTORY_SUMMARY_ENABLED,
+        **kwargs
+    ):
+        """
+        :param max_turns: 그대로 넣을 최근 턴 수 (0 이면 제한 없음)
+        :param max_tokens: 최근 대화 토큰 예산 (0 이면 제한 없음)
+        :param summarize: 범위를 벗어난 대화를 요약으로 유지할지 여부
+        """
+        super().__init__(*args, **kwargs)
+        self.max_turns = max_turns
+        self.max_tokens = max_tokens
+        self.summarize = summarize and bool(max_turns or max_tokens)
+        self._window_full = False
+
+    async def _acreate_table_if_not_exists(self) -> None:
+        table_name = self.sql_model_class.__tablename__
+        if table_name not in _ready_tables:
+            await super()._acreate_table_if_not_exists()
+            async with self.async_engine.begin() as conn:
+                await conn.run_sync(summary_metadata.create_all)
+            _ready_tables.add(table_name)
+        self._table_created = True
+
+    def _session_filter(self):
+        return getattr(self.sql_model_class, self.session_id_field_name) == self.session_id
+
+    async def _aread_records(self, session, pending: List[BaseMessage]) -> list:
+        # 최근 메세지를 id 역순으로 읽음 (턴 수 제한이면 한 번에, 토큰 예산만 있으면 예산이 찰 때까지 페이지 단위로)
+        model = self.sql_model_class
+        stmt = select(model).where(self._session_filter()).order_by(model.id.desc())
+        if self.max_turns:
+            return list((await session.execute(stmt.limit(self.max_turns * 2))).scalars())
+        if not self.max_tokens:
+            return list((await session.execute(stmt)).scalars())
+
+        records = []
+        used = sum(count_tokens(str(message.content)) for message in pending)
+        while used <= self.max_tokens:
+            page_stmt = stmt.limit(HISTORY_PAGE_SIZE)
+            if records:
+                page_stmt = page_stmt.where(model.id < records[-1].id)
+            page = list((await session.execute(page_stmt)).scalars())
+            for record in page:
+                records.append(record)
+                used += count_tokens(str(self.converter.from_sql_model(record).content))
+                if used > self.max_tokens:
+                    break
+            if len(page) < HISTORY_PAGE_SIZE:
+                break
+        return records
+
+    async def _aget_recent(self, session) -> List[Tuple[Optional[int], BaseMessage]]:
+        # 최근 메세지만 (id, message) 리스트로 반환, 아직 저장되지 않은 메세지는 id 가 None
+        while True:
+            generation = await history_writer.wait_stable()
+            pending = history_writer.pending_messages(self)
+            records = await self._aread_records(session, pending)
+            # 읽는 도중 저장이 일어났으면 같은 메세지를 두 번 읽을 수 있으므로 다시 읽음
+            if history_writer.generation == generation:
+                break
+
+        recent = [(record.id, self.converter.from_sql_model(record)) for record in records]
+        recent.reverse()
+        recent.extend((None, message) for message in pending)
+        loaded = len(recent)
+        if self.max_turns:
+            recent = recent[-self.max_turns * 2:]
+        recent = self._apply_token_budget(recent)
+
+        # 범위가 가득 찼거나 잘려 나간 메세지가 있으면, 이번 턴에 추가되는 메세지로 이전 메세지가 범위 밖으로 밀려남
+        self._window_full = len(recent) < loaded or bool(self.max_turns and len(recent) >= self.max_turns * 2)
+        return recent
+
+    def _apply_token_budget(self, recent: List[Tuple[int, BaseMessage]]) -> List[Tuple[int, BaseMessage]]:
+        if not self.max_tokens:
+            return recent
+
+        kept = []
+        used = 0
+        for message_id, message in reversed(recent):
+            tokens = count_tokens(str(message.content))
+            if kept and used + tokens > self.max_tokens:
+                break
+            kept.append((message_id, message))
+            used += tokens
+        kept.reverse()
+        return kept
+
+    async def _aget_summary(self, session) -> Optional[Tuple[str, int]]:
+        stmt = select(chat_summary_table.c.summary, chat_summary_table.c.last_message_id).where(
+            chat_summary_table.c.session_id == str(self.session_id)
+        )
+        row = (await session.execute(stmt)).first()
+        return (row.summary, row.last_message_id) if row else None
+
+    def _hot_key(self) -> str:
+        return f"chat_history:{self.sql_model_class.__tablename__}:{self.session_id}"
+
+    async def aget_messages(self) -> List[BaseMessage]:
+        hot_store = get_hot_store()
+
+        # 활성 대화는 핫 티어에서 바로 읽음
+        if hot_store is not None:
+            cached = await hot_store.get(self._hot_key())
+            if cached is not None:
+                summary, messages = cached
+                recent = self._apply_token_budget([(None, m) for m in messages])
+                self._window_full = (
+                    len(recent) < len(messages)
+                    or len(messages) >= hot_limit(self.max_turns * 2)
+                    or bool(self.max_turns and len(recent) >= self.max_turns * 2)
+                )
+                return self._with_summary(summary, recent)
+
+        await self._acreate_table_if_not_exists()
+        async with self._make_async_session() as session:
+            recent = await self._aget_recent(session)
+            summary = await self._aget_summary(session) if self.summarize else None
+        summary = summary[0] if summary else None
+
+        # 식은 대화는 SQL 에서 불러온 최근 범위로 핫 티어를 다시 채움
+        if hot_store is not None:
+            await hot_store.hydrate(self._hot_key(), summary, [m for _, m in recent], self.max_turns * 2)
+
+        return self._with_summary(summary, recent)
+
+    @staticmethod
+    def _with_summary(summary: Optional[str], recent: List[Tuple[Optional[int], BaseMessage]]) -> List[BaseMessage]:
+        messages = [message for _, message in recent]
+        if summary:
+            messages.insert(0, SystemMessage(content=f"Summary of the earlier conversation:\n{summary}"))
+        return messages
+
+    async def aadd_messages(self, messages: Sequence[BaseMessage]) -> None:
+        hot_store = get_hot_store()
+
+        # 핫 티어를 쓰면 SQL 저장은 항상 백그라운드로 (SQL 은 영구 저장소 역할)
+        if HISTORY_WRITE_BEHIND or hot_store is not None:
+            await self._acreate_table_if_not_exists()
+            history_writer.enqueue(self, messages)
+        else:
+            await super().aadd_messages(messages)
+
+        if hot_store is not None:
+            await hot_store.append(self._hot_key(), messages, self.max_turns * 2)
+
+        # 메세지가 실제로 범위 밖으로 밀려날 때만 요약 갱신 (읽을 때 범위가 가득 차 있었던 경우)
+        if self.summarize and self._window_full:
+            self._schedule_summary()
+
+    def _schedule_summary(self):
+        # 요약은 응답 경로 밖에서 백그라운드로 갱신
+        key = (self.sql_model_class.__tablename__, str(self.session_id))
+        if key in _summarizing:
+            return
+        _summarizing.add(key)
+
+        task = asyncio.create_task(self.aupdate_summary())
+        _background_tasks.add(task)
+
+        def done(t):
+            _background_tasks.discard(t)
+            _summarizing.discard(key)
+            if not t.cancelled() and t.exception() is not None:
+                print(f"대화 요약 갱신 실패 (session_id={self.session_id}): {t.exception()}")
+
+        task.add_done_callback(done)
+
+    async def aupdate_summary(self):
+        """
+        최근 대화 범위 밖으로 밀려났지만 아직 요약에 들어가지 않은 메세지를 요약에 합침
+        """
+        model = self.sql_model_class
+        async with self._make_async_session() as session:
+            recent = await self._aget_recent(session)
+            if not recent:
+                return
+            # 최근 범위가 전부 아직 저장되지 않은 메세지면 DB 의 메세지는 모두 범위 밖
+            boundary_id = recent[0][0]
+
+            current = await self._aget_summary(session)
+            summary, last_message_id = current if current else ("", 0)
+
+            stmt = select(model).where(self._session_filter(), model.id > last_message_id)
+            if boundary_id is not None:
+                stmt = stmt.where(model.id < boundary_id)
+            stmt = stmt.order_by(model.id.asc())
+            older = list((await session.execute(stmt)).scalars())
+
+        if len(older) < HISTORY_SUMMARY_MIN_MESSAGES:
+            return
+
+        # LLM 호출 동안 DB 커넥션을 잡고 있지 않도록 세션을 닫은 뒤 요약
+        new_summary = await summarize_messages(summary, [self.converter.from_sql_model(r) for r in older])
+
+        values = {"summary": new_summary, "last_message_id": older[-1].id, "updated_at": datetime.utcnow()}
+        async with self._make_async_session() as session:
+            if current:
+                await session.execute(
+                    update(chat_summary_table)
+                    .where(chat_summary_table.c.session_id == str(self.session_id))
+                    .values(**values)
+                )
+            else:
+                await session.execute(insert(chat_summary_table).values(session_id=str(self.session_id), **values))
+            await session.commit()
+
+        hot_store = get_hot_store()
+        if hot_store is not None:
+            await hot_store.set_summary(self._hot_key(), new_summary)
@@ -1,4 +1,7 @@
+import asyncio
 import os
+import threading
+import time
 from typing import Dict, Optional
 from click import prompt
 from langchain_core.runnables.history import RunnableWithMessageHistory
@@ -8,7 +11,7 @@ from langchain_experimental.text_splitter import SemanticChunker
 from langchain_community.vectorstores import FAISS
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.output_parsers import StrOutputParser
-from langchain_community.chat_message_histories import SQLChatMessageHistory
+from langchain_core.runnables import RunnableLambda
 from langchain_core.runnables.utils import ConfigurableFieldSpec
 from langchain_redis import RedisChatMessageHistory
 from langchain_community.document_loaders import WebBaseLoader
@@ -21,16 +24,126 @@ from scipy.io.wavfile import write
 import io
 from langchain.prompts.chat import SystemMessagePromptTemplate
 from langchain.prompts import PromptTemplate
+from index_store import INDEX_LAYOUT, build_vectorstore, compute_index_key, latest_index_key, load_index, load_or_build_shared_index, save_index
+from embedding_cache import CachedEmbeddings
+from embedding_coalescer import EmbeddingCoalescer
+from retrieval_cache import RetrievalCache
+from hybrid_retriever import RETRIEVAL_MODE, BM25Index, HybridRetriever
+from context_packing import pack_context
+from prompt_cache import cache_friendly_prompt, PromptCacheUsageHandler
+from retrieval_gate import RETRIEVAL_GATE, needs_retrieval, retrieval_gate
+from db import get_async_engine
+from chat_history import WindowedChatMessageHistory
 
 
 from dotenv import load_dotenv
 load_dotenv()
 
-embeddings = OpenAIEmbeddings()
+# SemanticChunker 와 FAISS 인덱싱이 함께 쓰는 임베딩 (영구 캐시 적용)
+# 캐시에 없는 질문 임베딩만 동시 요청끼리 모아서 한 번에 호출
+embedding_coalescer = EmbeddingCoalescer(OpenAIEmbeddings())
+embeddings = CachedEmbeddings(embedding_coalescer)
 
 # retriever global 선언
 CHARACTER_RETRIEVERS = {}
 
+# 공유 인덱스(INDEX_LAYOUT=shared)를 만들 때 쓰는 캐릭터별 (인덱스 키, 청크)
+CHARACTER_INDEX_SOURCES = {}
+
+# 캐릭터별 검색 결과 캐시 (캐릭터 인덱스가 새로 로드되면 해당 캐릭터만 비움)
+retrieval_cache = RetrievalCache(embeddings)
+
+# 캐릭터별 로딩 락과 실패 기록 (character_id -> 마지막 실패 시각)
+_RETRIEVER_LOCKS = {}
+_RETRIEVER_LOCKS_GUARD = threading.Lock()
+_RETRIEVER_FAILURES = {}
+
+# 로딩 실패 후 재시도까지 기다릴 시간(초)
+RETRIEVER_FAILURE_BACKOFF = float(os.getenv("RETRIEVER_FAILURE_BACKOFF", "30"))
+
+# SemanticChunker 설정 (바뀌면 인덱스 키가 바뀌어 재빌드됨)
+CHUNKER_SETTINGS = {"breakpoint_threshold_type": "percentile"}
+
+# character_id 와 PDF 경로 매핑
+CHARACTER_PDFS = {
+    1: "data/버즈.pdf",
+    2: "data/에스카노르.pdf",
+    3: "data/리바이.pdf",
+    4: "data/김전일.pdf",
+    5: "data/플랑크톤.pdf",
+    6: "data/스폰지밥.pdf"
+}
+
+CHARACTER_WEBPAGES = {
+    1: ["https://namu.wiki/w/%EB%B2%84%EC%A6%88%20%EB%9D%BC%EC%9D%B4%ED%8A%B8%EC%9D%B4%EC%96%B4",
+        "https://namu.wiki/w/%EB%B2%84%EC%A6%88%20%EB%9D%BC%EC%9D%B4%ED%8A%B8%EC%9D%B4%EC%96%B4/%EC%9E%91%EC%A4%91%20%ED%96%89%EC%A0%81"],
+    4: ["https://namu.wiki/w/소년탐정%20김전일",
+        # "https://namu.wiki/w/히호우도%20살인사건",
+        # "https://namu.wiki/w/히렌호%20전설%20살인사건",
+        # "https://namu.wiki/w/이진칸%20호텔%20살인사건",
+        # "https://namu.wiki/w/자살%20학원%20살인사건",
+        # "https://namu.wiki/w/타로%20산장%20살인사건",
+        # "https://namu.wiki/w/이진칸촌%20살인사건",
+        # "https://namu.wiki/w/오페라%20극장%20살인사건",
+        # "https://namu.wiki/w/괴도신사의%20살인",
+        # "https://namu.wiki/w/쿠치나시촌%20살인사건",
+        # "https://namu.wiki/w/밀랍인형성%20살인사건",
+        # "https://namu.wiki/w/유키야샤%20전설%20살인사건",
+        # "https://namu.wiki/w/학원%207대%20불가사의%20살인사건",
+        # "https://namu.wiki/w/마신%20유적%20살인사건",
+        # "https://namu.wiki/w/흑사접%20살인사건",
+        # "https://namu.wiki/w/마술%20열차%20살인사건",
+        # "https://namu.wiki/w/하카바섬%20살인사건",
+        # "https://namu.wiki/w/프랑스%20은화%20살인사건",
+        "https://namu.wiki/w/하야미%20레이카%20유괴%20살인사건"],
+    6: ["https://namu.wiki/w/네모바지%20스폰지밥(네모바지%20스폰지밥)/작중%20행적"],
+    2: ["https://namu.wiki/w/%EC%97%90%EC%8A%A4%EC%B9%B4%EB%85%B8%EB%A5%B4",
+        "https://namu.wiki/w/%EC%97%90%EC%8A%A4%EC%B9%B4%EB%85%B8%EB%A5%B4/%EC%9E%91%EC%A4%91%20%ED%96%89%EC%A0%81"]
+}
+
+def load_character_documents(character_id: int):
+    """
+    캐릭터 원본 문서 로드
+    :return: (문서 리스트, 모든 출처를 빠짐없이 불러왔는지 여부)
+    """
+    all_docs = []
+    complete = True
+
+    # web
+    if character_id in CHARACTER_WEBPAGES:
+        web_paths = CHARACTER_WEBPAGES[character_id]
+        for web_path in web_paths:
+            try:
+                web_loader = WebBaseLoader(web_path)
+                web_docs = web_loader.load()
+                if not any(d.page_content.strip() for d in web_docs):
+                    raise ValueError("내용이 비어 있습니다.")
+                all_docs.extend(web_docs)
+            except Exception as e:
+                complete = False
+                print(f"웹페이지({web_path})를 로드할 수 없습니다: {e}")
+
+    # PDF
+    if character_id in CHARACTER_PDFS:
+        pdf_path = CHARACTER_PDFS[character_id]
+        if os.path.exists(pdf_path):
+            try:
+                pdf_loader = PyMuPDFLoader(pdf_path)
+                pdf_docs = pdf_loader.load()
+                all_docs.extend(pdf_docs)
+            except Exception as e:
+                complete = False
+                print(f"PDF파일({pdf_path})을 로드할 수 없습니다: {e}")
+        else:
+            complete = False
+            print(f"PDF파일이 해당 경로에 존재하지 않습니다: {pdf_path}")
+
+    return all_docs, complete
+
+def _get_retriever_lock(character_id: int) -> threading.Lock:
+    with _RETRIEVER_LOCKS_GUARD:
+        return _RETRIEVER_LOCKS.setdefault(character_id, threading.Lock())
+
 def get_or_load_retriever(character_id: int):
     global CHARACTER_RETRIEVERS
 
@@ -38,136 +151,212 @@ def get_or_load_retriever(character_id: int):
     if character_id in CHARACTER_RETRIEVERS:
         print(character_id, "는 이미 로드되어 있습니다.")
         return CHARACTER_RETRIEVERS[character_id]
-    else:
-        print("캐릭터 id:", character_id, " 로딩 중...")
-    
-    # character_id 와 PDF 경로 매핑
-    character_pdfs = {
-        1: "data/버즈.pdf",
-        2: "data/에스카노르.pdf",
-        3: "data/리바이.pdf",
-        4: "data/김전일.pdf",
-        5: "data/플랑크톤.pdf",
-        6: "data/스폰지밥.pdf"
-    }
-
-    character_webpages = {
-        1: ["https://namu.wiki/w/%EB%B2%84%EC%A6%88%20%EB%9D%BC%EC%9D%B4%ED%8A%B8%EC%9D%B4%EC%96%B4",
-            "https://namu.wiki/w/%EB%B2%84%EC%A6%88%20%EB%9D%BC%EC%9D%B4%ED%8A%B8%EC%9D%B4%EC%96%B4/%EC%9E%91%EC%A4%91%20%ED%96%89%EC%A0%81"],
-        4: ["https://namu.wiki/w/소년탐정%20김전일",
-            # "https://namu.wiki/w/히호우도%20살인사건",
-            # "https://namu.wiki/w/히렌호%20전설%20살인사건",
-            # "https://namu.wiki/w/이진칸%20호텔%20살인사건",
-            # "https://namu.wiki/w/자살%20학원%20살인사건",
-            # "https://namu.wiki/w/타로%20산장%20살인사건",
-            # "https://namu.wiki/w/이진칸촌%20살인사건",
-            # "https://namu.wiki/w/오페라%20극장%20살인사건",
-            # "https://namu.wiki/w/괴도신사의%20살인",
-            # "https://namu.wiki/w/쿠치나시촌%20살인사건",
-            # "https://namu.wiki/w/밀랍인형성%20살인사건",
-            # "https://namu.wiki/w/유키야샤%20전설%20살인사건",
-            # "https://namu.wiki/w/학원%207대%20불가사의%20살인사건",
-            # "https://namu.wiki/w/마신%20유적%20살인사건",
-            # "https://namu.wiki/w/흑사접%20살인사건",
-            # "https://namu.wiki/w/마술%20열차%20살인사건",
-            # "https://namu.wiki/w/하카바섬%20살인사건",
-            # "https://namu.wiki/w/프랑스%20은화%20살인사건",
-            "https://namu.wiki/w/하야미%20레이카%20유괴%20살인사건"],
-        6: ["https://namu.wiki/w/네모바지%20스폰지밥(네모바지%20스폰지밥)/작중%20행적"],
-        2: ["https://namu.wiki/w/%EC%97%90%EC%8A%A4%EC%B9%B4%EB%85%B8%EB%A5%B4",
-            "https://namu.wiki/w/%EC%97%90%EC%8A%A4%EC%B9%B4%EB%85%B8%EB%A5%B4/%EC%9E%91%EC%A4%91%20%ED%96%89%EC%A0%81"]
-    }
 
-    try:
-        all_docs = []
-
-        # web
-        if character_id in character_webpages:
-            web_paths = character_webpages[character_id]
-            for web_path in web_paths:
-                try:
-                    web_loader = WebBaseLoader(web_path)
-                    web_docs = web_loader.load()
-                    all_docs.extend(web_docs)
-                except Exception as e:
-                    print(f"웹페이지({web_path})를 로드할 수 없습니다: {e}")
-
-        # PDF
-        if character_id in character_pdfs:
-            pdf_path = character_pdfs[character_id]
-            if os.path.exists(pdf_path):
-                pdf_loader = PyMuPDFLoader(pdf_path)
-                pdf_docs = pdf_loader.load()
-                all_docs.extend(pdf_docs)
-            else:
-                print(f"PDF파일이 해당 경로에 존재하지 않습니다: {pdf_path}")
+    # 같은 캐릭터는 한 번만 빌드하고, 동시에 들어온 요청은 그 결과를 기다렸다가 공유
+    with _get_retriever_lock(character_id):
+        if character_id in CHARACTER_RETRIEVERS:
+            return CHARACTER_RETRIEVERS[character_id]
 
-        if not all_docs:
-            print(f"캐릭터 아이디 {character_id}의 데이터를 찾을 수 없습니다.")
+        # 최근에 실패했으면 백오프 시간 동안은 다시 빌드하지 않음
+        failed_at = _RETRIEVER_FAILURES.get(character_id)
+        if failed_at is not None and time.monotonic() - failed_at < RETRIEVER_FAILURE_BACKOFF:
+            print("캐릭터 id:", character_id, " 최근 로딩 실패, 재시도 대기 중")
+            return None
+
+        print("캐릭터 id:", character_id, " 로딩 중...")
+        retriever = _build_retriever(character_id)
+
+        if retriever is None:
+            _RETRIEVER_FAILURES[character_id] = time.monotonic()
             return None
 
-        embeddings = OpenAIEmbeddings()
-        semantic_chunker = SemanticChunker(embeddings, breakpoint_threshold_type="percentile")
-        semantic_chunks = semantic_chunker.create_documents([d.page_content for d in all_docs])
-        vectorstore = FAISS.from_documents(documents=semantic_chunks, embedding=embeddings)
-        retriever = vectorstore.as_retriever()
+        _RETRIEVER_FAILURES.pop(character_id, None)
 
         # 글로벌에 없으면 저장
         CHARACTER_RETRIEVERS[character_id] = retriever
+        retrieval_cache.invalidate(character_id)
 
         print("캐릭터 id:", character_id, " 로드 완료")
         # print("로드된 캐릭터 개수: ", len(CHARACTER_RETRIEVERS))  # 몇 개의 캐릭터 정보를 로드했는지 확인
 
         return retriever
 
+def _build_retriever(character_id: int):
+    try:
+        all_docs, complete = load_character_documents(character_id)
+
+        # 원본 문서, 청커 설정, 임베딩 모델이 그대로면 저장된 인덱스를 재사용
+        index_key = compute_index_key(all_docs, CHUNKER_SETTINGS, embeddings.model) if all_docs else None
+        stored = load_index(character_id, index_key, embeddings) if index_key else None
+
+        # 일부 출처를 불러오지 못했으면 (일시적인 웹 수집 실패 등) 마지막으로 저장된 인덱스를 그대로 사용
+        if not stored and not complete:
+            previous_key = latest_index_key(character_id)
+            stored = load_index(character_id, previous_key, embeddings) if previous_key else None
+            if stored:
+                index_key = previous_key
+                print("캐릭터 id:", character_id, " 원본 문서 일부를 불러오지 못해 이전 인덱스 사용 (", index_key[:12], ")")
+
+        if not stored and not all_docs:
+            print(f"캐릭터 아이디 {character_id}의 데이터를 찾을 수 없습니다.")
+            return None
+
+        if stored:
+            vectorstore, semantic_chunks = stored
+            print("캐릭터 id:", character_id, " 저장된 인덱스 사용 (", index_key[:12], ")")
+        else:
+            semantic_chunker = SemanticChunker(embeddings, **CHUNKER_SETTINGS)
+            semantic_chunks = semantic_chunker.create_documents([d.page_content for d in all_docs])
+            vectorstore = build_vectorstore(semantic_chunks, embeddings)
+            # 저장에 실패해도 만든 인덱스는 그대로 사용 (다음 시작 때 다시 빌드)
+            try:
+                # 원본 문서를 모두 불러와서 만든 인덱스일 때만 이전 인덱스를 삭제
+                save_index(character_id, index_key, vectorstore, semantic_chunks, {"model": embeddings.model, "chunker": CHUNKER_SETTINGS, "complete": complete}, prune=complete)
+            except Exception as e:
+                print(f"캐릭터 id: {character_id} 인덱스를 저장할 수 없습니다: {e}")
+            else:
+                # 처음 만든 인덱스도 저장된 파일을 다시 열어서 mmap 으로 사용 (INDEX_MMAP)
+                stored = load_index(character_id, index_key, embeddings)
+                if stored:
+                    vectorstore, semantic_chunks = stored
+            print("캐릭터 id:", character_id, " 임베딩 캐시 적중률:", embeddings.stats())
+
+        if INDEX_LAYOUT == "shared":
+            CHARACTER_INDEX_SOURCES[character_id] = (index_key, semantic_chunks)
+
+        # 저장된 청크로 BM25 인덱스를 만들어 FAISS 와 함께 검색 (RETRIEVAL_MODE, vector 면 만들지 않음)
+        lexical_index = BM25Index(semantic_chunks) if RETRIEVAL_MODE != "vector" else None
+        return HybridRetriever(vectorstore=vectorstore, lexical_index=lexical_index)
+
     except Exception as e:
         print(f"해당 캐릭터 번호의 데이터를 로드할 수 없습니다: {e}")
         return None
 
-def setup_chat_chain(character_id: int):
-    # Lazy-load the retriever
-    retriever = get_or_load_retriever(character_id)
-    
-    prompt = get_prompt_by_character_id(character_id)
-    
-    if character_id == 1:
-        llm = ChatOpenAI(model="gpt-4o-mini", temperature=0.3)
-    elif character_id == 2:
-        llm = ChatOpenAI(model="gpt-4o-mini", temperature=0.3)
-    elif character_id == 3:
-        llm = ChatOpenAI(model="gpt-4o-mini", temperature=0.3)
-    elif character_id == 4:
-        llm = ChatOpenAI(model="gpt-4o-mini", temperature=0.3)
-    elif character_id == 5:
-        llm = ChatOpenAI(model="gpt-4o-mini", temperature=0.3)
-    elif character_id == 6:
-        llm = ChatOpenAI(model="gpt-4o-mini", temperature=0.3)
-    else:
-        llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)
+def use_shared_index():
+    """
+    로드된 캐릭터들의 청크를 인덱스 하나로 합치고, 각 캐릭터 retriever 가 자기 id 범위만 검색하도록 교체 (INDEX_LAYOUT=shared)
+    이후에 새로 로드되는 캐릭터는 다음 호출(재시작) 전까지 캐릭터별 인덱스를 사용한다.
+    """
+    sources = dict(CHARACTER_INDEX_SOURCES)
+    if not sources:
+        return
+    try:
+        views = load_or_build_shared_index(sources, embeddings)
+    except Exception as e:
+        print(f"공유 인덱스를 만들 수 없어서 캐릭터별 인덱스를 사용합니다: {e}")
+        return
 
-    chain = (
-        {
-            "question": lambda x: x["question"], 
-            "chat_message": lambda x: x["chat_message"], 
-            "relevant_info": lambda x: retriever.invoke(x["question"]) if retriever else None
-        }
-        | prompt
-        | llm
-        | StrOutputParser()
+    for character_id, vectorstore in views.items():
+        retriever = CHARACTER_RETRIEVERS.get(character_id)
+        if retriever is not None:
+            lexical_index = retriever.lexical_index
+        else:
+            lexical_index = BM25Index(sources[character_id][1]) if RETRIEVAL_MODE != "vector" else None
+        CHARACTER_RETRIEVERS[character_id] = HybridRetriever(vectorstore=vectorstore, lexical_index=lexical_index)
+        retrieval_cache.invalidate(character_id)
+    print("공유 인덱스로 전환 완료:", sorted(views))
+
+# 밸런스 게임에서 프롬프트를 바꾸는 키워드 (캐릭터별 변형 프롬프트를 미리 만들어 둠)
+BALANCE_KEYWORDS = ["난폭한", "피곤한"]
+
+# 미리 만들어 둔 캐릭터별 LLM / 체인 (character_id -> 객체)
+CHARACTER_LLMS = {}
+CHAT_CHAINS = {}
+BALANCE_CHAT_CHAINS = {}
+GROUP_CHAT_CHAINS = {}
+_CHAIN_LOCK = threading.Lock()
+
+def get_llm(character_id: int) -> ChatOpenAI:
+    # 캐릭터별 ChatOpenAI 클라이언트(HTTP 커넥션 풀 포함)를 한 번만 만들어 재사용
+    llm = CHARACTER_LLMS.get(character_id)
+    if llm is None:
+        # stream_usage: 스트리밍에서도 usage(캐시된 프롬프트 토큰 포함)를 받아서 기록
+        llm = ChatOpenAI(
+            model="gpt-4o-mini",
+            temperature=0.3 if character_id in range(1, 7) else 0,
+            stream_usage=True,
+            callbacks=[PromptCacheUsageHandler(character_id)]
+        )
+        CHARACTER_LLMS[character_id] = llm
+    return llm
+
+def relevant_info_step(character_id: int) -> RunnableLambda:
+    # 체인은 서버 시작 시 만들어지므로 retriever 는 요청 시점에 찾음 (백그라운드 로딩/재빌드 반영)
+    # 입력에 relevant_info 가 이미 있으면 (단체방처럼 검색을 미리 한 경우) 그대로 사용
+    # 인사/맞장구 같은 잡담은 검색하지 않음 (RETRIEVAL_GATE)
+    # 검색 결과는 메타데이터 없이 본문만, 중복을 빼고 캐릭터별 토큰 예산까지만 넣음 (CONTEXT_TOKEN_BUDGET)
+    def retrieve(x):
+        if "relevant_info" in x:
+            return x["relevant_info"]
+        if not retrieval_gate.check(character_id, x["question"]):
+            return ""
+        started = time.perf_counter()
+        retriever = get_or_load_retriever(character_id)
+        docs = retrieval_cache.retrieve(character_id, retriever, x["question"]) if retriever else None
+        retrieval_gate.record_retrieval(time.perf_counter() - started)
+        return pack_context(character_id, docs)
+
+    async def aretrieve(x):
+        if "relevant_info" in x:
+            return x["relevant_info"]
+        if not retrieval_gate.check(character_id, x["question"]):
+            return ""
+        started = time.perf_counter()
+        retriever = CHARACTER_RETRIEVERS.get(character_id)
+        if retriever is None:
+            retriever = await asyncio.to_thread(get_or_load_retriever, character_id)
+        docs = await retrieval_cache.aretrieve(character_id, retriever, x["question"]) if retriever else None
+        retrieval_gate.record_retrieval(time.perf_counter() - started)
+        return pack_context(character_id, docs)
+
+    return RunnableLambda(retrieve, afunc=aretrieve)
+
+async def aretrieve_by_vector(character_id: int, question: str, query_vector) -> str:
+    """
+    이미 계산된 질문 임베딩으로 검색 (여러 캐릭터가 같은 질문에 답할 때 임베딩 호출을 한 번만 하기 위함)
+    :param question: 질문 (검색 결과 캐시 키)
+    :param query_vector: 질문 임베딩
+    :return: relevant_info 에 넣을 텍스트 (retriever 가 없거나 검색이 필요 없는 질문이면 빈 문자열)
+    """
+    if not retrieval_gate.check(character_id, question):
+        return ""
+    started = time.perf_counter()
+    retriever = CHARACTER_RETRIEVERS.get(character_id)
+    if retriever is None:
+        retriever = await asyncio.to_thread(get_or_load_retriever, character_id)
+    docs = await retrieval_cache.aretrieve(character_id, retriever, question, query_vector=query_vector) if retriever else None
+    retrieval_gate.record_retrieval(time.perf_counter() - started)
+    return pack_context(character_id, docs)
+
+def needs_query_vector(character_ids, question: str) -> bool:
+    """
+    단체방에서 질문 임베딩을 미리 계산할 필요가 있는지 (검색을 생략하는 잡담이거나 모두 lexical 검색이면 필요 없음)
+    """
+    if RETRIEVAL_GATE and not needs_retrieval(question)[0]:
+        return False
+    for character_id in character_ids:
+        retriever = CHARACTER_RETRIEVERS.get(character_id)
+        if retriever.needs_query_vector() if retriever is not None else RETRIEVAL_MODE != "lexical":
+            return True
+    return False
+
+def get_chat_message_history(conversation_id: int) -> WindowedChatMessageHistory:
+    # 최근 대화만 그대로 넣고 이전 대화는 요약으로 대체 (HISTORY_MAX_TURNS / HISTORY_MAX_TOKENS)
+    return WindowedChatMessageHistory(
+        table_name="chat_message",
+        session_id=conversation_id,
+        connection=get_async_engine()
     )
 
+def with_message_history(chain):
     def get_chat_message(user_id, conversation_id):
-        return SQLChatMessageHistory(
-            table_name="chat_message",
-            session_id=conversation_id,
-            connection=os.getenv("ENV_CONNECTION")
-        )
-    
+        return get_chat_message_history(conversation_id)
+
     config_field = [
         ConfigurableFieldSpec(id="user_id", annotation=int, is_shared=True),
         ConfigurableFieldSpec(id="conversation_id", annotation=int, is_shared=True)
     ]
-    
+
     return RunnableWithMessageHistory(
         chain,
         get_chat_message,
@@ -176,81 +365,95 @@ def setup_chat_chain(character_id: int):
         history_factory_config=config_field
     )
 
-def setup_balanceChat_chain(character_id: int, keyword: Optional[str] = None, situation: Optional[str] = None):
-    # Lazy-load the retriever
-    retriever = get_or_load_retriever(character_id)
+def setup_chat_core_chain(character_id: int):
+    # 히스토리 연결 전 체인 (입력: question, chat_message, 선택적으로 relevant_info)
+    prompt = get_prompt_by_character_id(character_id)
+    llm = get_llm(character_id)
 
-    prompt = get_prompt_by_character_id(character_id, keyword, situation)
+    return (
+        {
+            "question": lambda x: x["question"], 
+            "chat_message": lambda x: x["chat_message"], 
+            "relevant_info": relevant_info_step(character_id)
+        }
+        | prompt
+        | llm
+        | StrOutputParser()
+    )
 
-    if situation:
-        if isinstance(prompt, ChatPromptTemplate):
-            for message in prompt.messages:
-                if hasattr(message, "prompt") and isinstance(message.prompt, PromptTemplate):
-                    message.prompt.template = message.prompt.template.replace("{situation}", situation)
-        else:
-            raise TypeError(f"Expected 'prompt' to be a ChatPromptTemplate, got {type(prompt)}")
-        
-    
-    print("🍔🍔🍔🍔", prompt)
-    
+def setup_chat_chain(character_id: int):
+    return with_message_history(setup_chat_core_chain(character_id))
 
-    # LLM setup
-    # llm = ChatOpenAI(model="gpt-4o-mini", temperature=0.3 if character_id in range(1, 7) else 0)
-    if character_id == 1:
-        llm = ChatOpenAI(model="gpt-4o-mini", temperature=0.3)
-    elif character_id == 2:
-        llm = ChatOpenAI(model="gpt-4o-mini", temperature=0.3)
-    elif character_id == 3:
-        llm = ChatOpenAI(model="gpt-4o-mini", temperature=0.3)
-    elif character_id == 4:
-        llm = ChatOpenAI(model="gpt-4o-mini", temperature=0.3)
-    elif character_id == 5:
-        llm = ChatOpenAI(model="gpt-4o-mini", temperature=0.3)
-    elif character_id == 6:
-        llm = ChatOpenAI(model="gpt-4o-mini", temperature=0.3)
-    else:
-        llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)
+def setup_balanceChat_chain(character_id: int):
+    # 키워드별 프롬프트를 미리 만들어 두고, 요청의 config["configurable"]["keyword"] 로 선택
+    prompts = {keyword: get_prompt_by_character_id(character_id, keyword) for keyword in BALANCE_KEYWORDS}
+    default_prompt = get_prompt_by_character_id(character_id)
 
+    def select_prompt(x, config):
+        keyword = config.get("configurable", {}).get("keyword")
+        return prompts.get(keyword, default_prompt)
 
-    if isinstance(prompt, str):
-        prompt = ChatPromptTemplate.from_messages([
-            ("system", prompt),
-            MessagesPlaceholder(variable_name="chat_message"),
-            ("human", "{question}")
-        ])
+    llm = get_llm(character_id)
 
     chain = (
         {
             "question": lambda x: x["question"],
             "chat_message": lambda x: x["chat_message"],
-            "relevant_info": lambda x: retriever.invoke(x["question"]) if retriever else None,
-            "situation": lambda x: situation if situation else None
+            "relevant_info": relevant_info_step(character_id),
+            "situation": lambda x, config: config.get("configurable", {}).get("situation")
         }
-        | prompt 
+        | RunnableLambda(select_prompt)
         | llm
         | StrOutputParser()
     )
 
-    def get_chat_message(user_id, conversation_id):
-        return SQLChatMessageHistory(
-            table_name="chat_message",
-            session_id=conversation_id,
-            connection=os.getenv("ENV_CONNECTION")
-        )
-
-    config_field = [
-        ConfigurableFieldSpec(id="user_id", annotation=int, is_shared=True),
-        ConfigurableFieldSpec(id="conversation_id", annotation=int, is_shared=True),
-    ]
-
-    return RunnableWithMessageHistory(
-        chain,
-        get_chat_message,
-        input_messages_key="question",
-        history_messages_key="chat_message",
-        history_factory_config=config_field
-    )
-
+    return with_message_history(chain)
+
+def get_chat_chain(character_id: int):
+    chain = CHAT_CHAINS.get(character_id)
+    if chain is None:
+        with _CHAIN_LOCK:
+            chain = CHAT_CHAINS.get(character_id)
+            if chain is None:
+                chain = CHAT_CHAINS[character_id] = setup_chat_chain(character_id)
+    return chain
+
+def get_balance_chat_chain(character_id: int):
+    chain = BALANCE_CHAT_CHAINS.get(character_id)
+    if chain is None:
+        with _CHAIN_LOCK:
+            chain = BALANCE_CHAT_CHAINS.get(character_id)
+            if chain is None:
+                chain = BALANCE_CHAT_CHAINS[character_id] = setup_balanceChat_chain(character_id)
+    return chain
+
+def get_group_chat_chain(character_id: int):
+    # 단체방용 체인, 히스토리 읽기/저장은 호출하는 쪽에서 한 번만 처리
+    chain = GROUP_CHAT_CHAINS.get(character_id)
+    if chain is None:
+        with _CHAIN_LOCK:
+            chain = GROUP_CHAT_CHAINS.get(character_id)
+            if chain is None:
+                chain = GROUP_CHAT_CHAINS[character_id] = setup_chat_core_chain(character_id)
+    return chain
+
+def build_chain_registry(character_ids):
+    # 서버 시작 시 모든 캐릭터의 체인을 미리 생성
+    for character_id in character_ids:
+        get_chat_chain(character_id)
+        get_balance_chat_chain(character_id)
+        get_group_chat_chain(character_id)
+
+
+# 단체방 캐릭터 매칭에 쓰는 캐릭터 설명 (LLM 프롬프트와 임베딩 라우터가 함께 사용)
+CHARACTER_DESCRIPTIONS = {
+    6: "스폰지밥 (SpongeBob SquarePants) - A cheerful sea sponge living in 비키니 시티, loves jellyfishing and working at the 집게리아. (From *SpongeBob SquarePants*)",
+    5: "플랑크톤 (Plankton) - A scheming microbe from 비키니 시티 who often plots to steal the 게살버거 formula. (From *SpongeBob SquarePants*)",
+    1: "버즈 (Buzz Lightyear) - A space ranger toy from the *Toy Story* universe, brave and adventurous. (From *Toy Story*)",
+    4: "김전일 (Kindaichi) - A high school detective with exceptional reasoning skills, often solving complex murder cases. (From *Kindaichi Case Files*)",
+    3: "리바이 (Levi Ackerman) - A skilled soldier and captain of the Survey Corps from *Attack on Titan*, known for his agility, precision, and cold demeanor.",
+    2: "에스카노르 (Escanor) - The Lion's Sin of Pride from *Seven Deadly Sins*, confident and powerful during the day, timid at night."
+}
 
 def setup_character_matching_prompt():
     prompt = ChatPromptTemplate.from_messages(
@@ -320,18 +523,19 @@ def emotion_analyzation_prompt():
 
 # 캐릭터에 따라 프롬프트 변경
 def get_prompt_by_character_id(character_id: int, keyword: Optional[str] = None, situation: Optional[str] = None ):
+    # 페르소나 부분이 항상 같은 문자열로 앞에 오도록 재구성 (PROMPT_PREFIX_CACHE), 에스카노르는 낮/밤 프롬프트 각각 적용
     if character_id == 6:
-        return setup_spongebob_prompt(keyword, situation)
+        return cache_friendly_prompt(setup_spongebob_prompt(keyword, situation))
     elif character_id == 5:
-        return setup_plankton_prompt(keyword)
+        return cache_friendly_prompt(setup_plankton_prompt(keyword))
     elif character_id == 4:
-        return setup_kimjeonil_prompt(keyword)
+        return cache_friendly_prompt(setup_kimjeonil_prompt(keyword))
     elif character_id == 3:
-        return setup_levi_prompt(keyword)
+        return cache_friendly_prompt(setup_levi_prompt(keyword))
     elif character_id == 2:
         return setup_escanor_prompt(keyword)
     elif character_id == 1:
-        return setup_buzz_prompt(keyword)
+        return cache_friendly_prompt(setup_buzz_prompt(keyword))
     else:
         raise ValueError(f"존재하지 않는 캐릭터 번호: {character_id}")
     
@@ -407,16 +611,23 @@ def setup_escanor_prompt(keyword: Optional[str] = None):
         ]
     )
     
+    day_prompt = cache_friendly_prompt(day_prompt)
+    night_prompt = cache_friendly_prompt(night_prompt)
+
+    # 낮/밤 프롬프트는 한 번만 만들고, 요청이 들어온 시각에 맞는 프롬프트를 선택
+    def select_prompt(x):
+        return day_prompt if is_escanor_daytime() else night_prompt
+
+    return RunnableLambda(select_prompt)
+
+def is_escanor_daytime() -> bool:
     # KST = timezone(timedelta(hours=9))
     BST = timezone(timedelta(hours=-3))
     # current_time = datetime.now(KST)
     current_time = datetime.now(BST)
     hour = current_time.hour
     # 낮 (6시 ~ 18시)
-    if 6 <= hour < 18:
-        return day_prompt
-    else:
-        return night_prompt
+    return 6 <= hour < 18
 
 # 스폰지밥 프롬프트
 def setup_spongebob_prompt(keyword: Optional[str] = None, situation: Optional[str] = None):
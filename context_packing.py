@@ -0,0 +1,133 @@
+import json
+import os
+import re
+import threading
+from typing import List, Optional
+
+from langchain_core.documents import Document
+
+from token_count import count_tokens
+
+# relevant_info 에 넣을 최대 토큰 수 (기본값과 캐릭터별 설정, 예: CONTEXT_TOKEN_BUDGETS='{"6": 400}')
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "600"))
+CONTEXT_TOKEN_BUDGETS = {int(k): int(v) for k, v in json.loads(os.getenv("CONTEXT_TOKEN_BUDGETS", "{}")).items()}
+
+# 두 청크의 bigram 이 이 비율 이상 겹치면 중복으로 보고 뒤의 것을 버림
+CONTEXT_DEDUP_THRESHOLD = float(os.getenv("CONTEXT_DEDUP_THRESHOLD", "0.8"))
+
+# 요청마다 포함된 토큰 수 출력 여부 (같은 값은 /metrics 의 context_packing 에서 확인)
+CONTEXT_PACKING_LOG = os.getenv("CONTEXT_PACKING_LOG", "false").lower() == "true"
+
+_WHITESPACE_PATTERN = re.compile(r"\s+")
+
+
+def get_context_budget(character_id: int) -> int:
+    return CONTEXT_TOKEN_BUDGETS.get(character_id, CONTEXT_TOKEN_BUDGET)
+
+
+def _bigrams(text: str) -> set:
+    compact = text.replace(" ", "")
+    return {compact[i:i + 2] for i in range(len(compact) - 1)}
+
+
+def _is_duplicate(text: str, grams: set, kept: List[tuple]) -> bool:
+    for kept_text, kept_grams in kept:
+        if text in kept_text or kept_text in text:
+            return True
+        smaller = min(len(grams), len(kept_grams))
+        if smaller and len(grams & kept_grams) / smaller >= CONTEXT_DEDUP_THRESHOLD:
+            return True
+    return False
+
+
+def _truncate(text: str, budget: int) -> str:
+    # 토큰 수가 예산에 맞을 때까지 글자 수 비율로 줄임
+    tokens = count_tokens(text)
+    while text and tokens > budget:
+        text = text[:max(1, int(len(text) * budget / tokens * 0.95))]
+        tokens = count_tokens(text)
+    return text
+
+
+class ContextPackingStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.tokens_included = 0
+        self.tokens_retrieved = 0
+        self.chunks_included = 0
+        self.chunks_deduped = 0
+        self.chunks_dropped = 0
+
+    def record(self, retrieved: int, included: int, chunks_included: int, deduped: int, dropped: int):
+        with self._lock:
+            self.requests += 1
+            self.tokens_retrieved += retrieved
+            self.tokens_included += included
+            self.chunks_included += chunks_included
+            self.chunks_deduped += deduped
+            self.chunks_dropped += dropped
+
+    def stats(self) -> dict:
+        with self._lock:
+            requests = self.requests or 1
+            return {
+                "requests": self.requests,
+                "avg_tokens_included": round(self.tokens_included / requests, 1),
+                "avg_tokens_retrieved": round(self.tokens_retrieved / requests, 1),
+                "avg_chunks_included": round(self.chunks_included / requests, 2),
+                "chunks_deduped": self.chunks_deduped,
+                "chunks_dropped": self.chunks_dropped
+            }
+
+
+packing_stats = ContextPackingStats()
+
+
+def pack_context(character_id: int, docs: Optional[List[Document]], budget: Optional[int] = None) -> str:
+    """
+    검색된 청크를 프롬프트용 텍스트로 정리
+    메타데이터는 버리고 본문만 남기며, 겹치는 청크를 빼고 검색 순위(점수 순)대로 토큰 예산까지 채운다.
+    :param character_id: 캐릭터 id (캐릭터별 예산)
+    :param docs: retriever 결과 (점수가 높은 순)
+    :param budget: 토큰 예산 (없으면 캐릭터 설정 사용)
+    :return: relevant_info 에 넣을 텍스트
+    """
+    if not docs:
+        return ""
+    budget = get_context_budget(character_id) if budget is None else budget
+
+    kept = []           # (텍스트, bigram)
+    deduped = 0
+    for doc in docs:
+        text = _WHITESPACE_PATTERN.sub(" ", doc.page_content).strip()
+        if not text:
+            continue
+        grams = _bigrams(text)
+        if _is_duplicate(text, grams, kept):
+            deduped += 1
+            continue
+        kept.append((text, grams))
+
+    separator_tokens = count_tokens("\n\n")
+    parts = []
+    used = 0
+    retrieved = 0
+    for text, _ in kept:
+        tokens = count_tokens(text)
+        retrieved += tokens
+        cost = tokens + (separator_tokens if parts else 0)
+        if used + cost <= budget:
+            parts.append(text)
+            used += cost
+        elif not parts:
+            # 첫 청크가 예산보다 크면 잘라서라도 넣음
+            text = _truncate(text, budget)
+            parts.append(text)
+            used += count_tokens(text)
+
+    dropped = len(kept) - len(parts)
+    packing_stats.record(retrieved, used, len(parts), deduped, dropped)
+    if CONTEXT_PACKING_LOG:
+        print(f"캐릭터 id: {character_id} relevant_info 토큰 {used}/{budget} (청크 {len(parts)}/{len(docs)}, 중복 {deduped}, 제외 {dropped})")
+    return "\n\n".join(parts)
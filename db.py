@@ -0,0 +1,107 @@
+import os
+import threading
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from dotenv import load_dotenv
+load_dotenv()
+
+DATABASE_URL = os.getenv("ENV_CONNECTION")
+
+# 커넥션 풀 설정
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))    # 초, DB 서버의 wait_timeout 보다 짧게
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+
+# 동기 드라이버 -> 비동기 드라이버 매핑
+ASYNC_DRIVERS = {
+    "mysql": "mysql+aiomysql",
+    "mysql+pymysql": "mysql+aiomysql",
+    "mysql+mysqldb": "mysql+aiomysql",
+    "postgresql": "postgresql+asyncpg",
+    "postgresql+psycopg2": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite"
+}
+
+_async_engine = None
+_engine_lock = threading.Lock()
+
+# 풀 이벤트 카운터 (이벤트 -> 횟수)
+_pool_events = {"connect": 0, "checkout": 0, "checkin": 0, "invalidate": 0}
+
+
+def get_async_connection_string() -> str:
+    # ENV_ASYNC_CONNECTION 이 없으면 ENV_CONNECTION 의 드라이버만 비동기 드라이버로 바꿔서 사용
+    connection = os.getenv("ENV_ASYNC_CONNECTION")
+    if connection:
+        return connection
+
+    scheme, sep, rest = DATABASE_URL.partition("://")
+    return ASYNC_DRIVERS.get(scheme, scheme) + sep + rest
+
+
+def _pool_args(url: str) -> dict:
+    # sqlite 는 풀 크기 설정을 받지 않음
+    if url.startswith("sqlite"):
+        return {}
+    return {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_pre_ping": True,
+    }
+
+
+def _track_pool_events(sync_engine):
+    counters = _pool_events
+
+    def make_listener(name):
+        def listener(*args):
+            counters[name] += 1
+        return listener
+
+    for name in counters:
+        event.listen(sync_engine, name, make_listener(name))
+
+
+def get_async_engine():
+    """
+    프로세스 전체에서 공유하는 비동기 엔진 (채팅 히스토리 읽기/쓰기용)
+    """
+    global _async_engine
+    if _async_engine is None:
+        with _engine_lock:
+            if _async_engine is None:
+                url = get_async_connection_string()
+                engine = create_async_engine(url, **_pool_args(url))
+                _track_pool_events(engine.sync_engine)
+                _async_engine = engine
+    return _async_engine
+
+
+def _pool_status(engine) -> dict:
+    status = {"events": dict(_pool_events)}
+    if engine is None:
+        return status
+
+    pool = engine.pool
+    for name in ("size", "checkedin", "checkedout", "overflow"):
+        if hasattr(pool, name):
+            status[name] = getattr(pool, name)()
+    return status
+
+
+def pool_stats() -> dict:
+    return {
+        "async": _pool_status(_async_engine.sync_engine if _async_engine else None),
+    }
+
+
+async def dispose_engines():
+    global _async_engine
+    if _async_engine is not None:
+        await _async_engine.dispose()
+        _async_engine = None
@@ -0,0 +1,160 @@
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+# 임베딩 캐시 파일 경로 (재시작해도 유지됨)
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "embedding_cache.sqlite3")
+
+# 질문 임베딩은 파일에 저장하지 않고 메모리에 최근 것만 보관 (사용자 질문이 파일에 계속 쌓이지 않도록)
+EMBEDDING_QUERY_CACHE_SIZE = int(os.getenv("EMBEDDING_QUERY_CACHE_SIZE", "1024"))
+
+# sqlite IN (...) 절에 한 번에 넣을 키 개수
+_LOOKUP_CHUNK = 500
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    텍스트 해시 + 모델 이름을 키로 하는 영구 임베딩 캐시
+    캐시에 없는 텍스트만 모아서 한 번에 임베딩하고, 적중률을 기록한다.
+    문서(청크) 임베딩만 sqlite 에 저장하고, 질문 임베딩은 크기가 정해진 메모리 LRU 에만 둔다.
+    """
+
+    def __init__(self, underlying: Embeddings, path: str = EMBEDDING_CACHE_PATH):
+        """
+        :param underlying: 실제 임베딩을 계산할 객체 (예: OpenAIEmbeddings)
+        :param path: sqlite 캐시 파일 경로
+        """
+        self.underlying = underlying
+        self.model = getattr(underlying, "model", type(underlying).__name__)
+        self.hits = 0
+        self.misses = 0
+
+        self.query_hits = 0
+        self.query_misses = 0
+        self._query_cache = OrderedDict()
+        self._query_lock = threading.Lock()
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS embedding_cache (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+            self._conn.commit()
+
+    def _key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.model}\0{text}".encode("utf-8")).hexdigest()
+
+    def _lookup(self, keys: Iterable[str]) -> Dict[str, List[float]]:
+        keys = list(keys)
+        found = {}
+        with self._lock:
+            for i in range(0, len(keys), _LOOKUP_CHUNK):
+                chunk = keys[i:i + _LOOKUP_CHUNK]
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embedding_cache WHERE key IN ({','.join('?' * len(chunk))})",
+                    chunk,
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32).tolist()
+        return found
+
+    def _store(self, items: Dict[str, List[float]]):
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embedding_cache (key, vector) VALUES (?, ?)",
+                [(key, np.asarray(vector, dtype=np.float32).tobytes()) for key, vector in items.items()],
+            )
+            self._conn.commit()
+
+    def _split(self, texts: List[str]):
+        keys = [self._key(text) for text in texts]
+        found = self._lookup(set(keys))
+
+        # 캐시에 없는 텍스트 (중복은 한 번만)
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in missing:
+                missing[key] = text
+
+        hit_count = sum(1 for key in keys if key in found)
+        with self._lock:
+            self.hits += hit_count
+            self.misses += len(keys) - hit_count
+
+        return keys, found, missing
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys, found, missing = self._split(texts)
+        if missing:
+            vectors = self.underlying.embed_documents(list(missing.values()))
+            computed = dict(zip(missing.keys(), vectors))
+            self._store(computed)
+            found.update(computed)
+        return [found[key] for key in keys]
+
+    def _query_lookup(self, key: str):
+        with self._query_lock:
+            vector = self._query_cache.get(key)
+            if vector is None:
+                self.query_misses += 1
+                return None
+            self._query_cache.move_to_end(key)
+            self.query_hits += 1
+            return vector
+
+    def _query_store(self, key: str, vector: List[float]):
+        with self._query_lock:
+            self._query_cache[key] = vector
+            self._query_cache.move_to_end(key)
+            while len(self._query_cache) > EMBEDDING_QUERY_CACHE_SIZE:
+                self._query_cache.popitem(last=False)
+
+    def embed_query(self, text: str) -> List[float]:
+        key = self._key(text)
+        vector = self._query_lookup(key)
+        if vector is None:
+            vector = self.underlying.embed_query(text)
+            self._query_store(key, vector)
+        return vector
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        # sqlite 조회/저장(commit)은 이벤트 루프를 막지 않도록 스레드에서 실행
+        keys, found, missing = await asyncio.to_thread(self._split, texts)
+        if missing:
+            vectors = await self.underlying.aembed_documents(list(missing.values()))
+            computed = dict(zip(missing.keys(), vectors))
+            await asyncio.to_thread(self._store, computed)
+            found.update(computed)
+        return [found[key] for key in keys]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        # 요청마다 부르는 경로이므로 파일 I/O 없이 메모리에서만 찾음
+        key = self._key(text)
+        vector = self._query_lookup(key)
+        if vector is None:
+            vector = await self.underlying.aembed_query(text)
+            self._query_store(key, vector)
+        return vector
+
+    def hit_rate(self) -> float:
+        hits = self.hits + self.query_hits
+        total = hits + self.misses + self.query_misses
+        return hits / total if total else 0.0
+
+    def stats(self) -> dict:
+        return {
+            "model": self.model,
+            "hits": self.hits + self.query_hits,
+            "misses": self.misses + self.query_misses,
+            "hit_rate": round(self.hit_rate(), 4),
+            "query_hits": self.query_hits,
+            "query_misses": self.query_misses,
+            "query_entries": len(self._query_cache),
+        }
@@ -0,0 +1,104 @@
+import asyncio
+import os
+from typing import List
+
+from langchain_core.embeddings import Embeddings
+
+# 동시에 들어온 질문 임베딩을 모으는 최대 대기 시간(ms)과 한 번에 보낼 최대 개수
+EMBEDDING_BATCH_WINDOW_MS = float(os.getenv("EMBEDDING_BATCH_WINDOW_MS", "5"))
+EMBEDDING_BATCH_MAX_SIZE = int(os.getenv("EMBEDDING_BATCH_MAX_SIZE", "64"))
+
+
+class EmbeddingCoalescer(Embeddings):
+    """
+    여러 요청의 질문 임베딩(aembed_query)을 짧은 시간 동안 모아 한 번의 배치 호출로 처리
+    문서 임베딩은 이미 배치이므로 그대로 전달한다.
+    CachedEmbeddings 안쪽에 두어서 캐시에 있는 질문은 대기 없이 바로 반환되도록 사용한다.
+    """
+
+    def __init__(self, underlying: Embeddings, window_ms: float = EMBEDDING_BATCH_WINDOW_MS, max_size: int = EMBEDDING_BATCH_MAX_SIZE):
+        """
+        :param underlying: 실제 임베딩을 계산할 객체 (예: OpenAIEmbeddings)
+        :param window_ms: 첫 질문이 들어온 뒤 배치를 보내기까지 기다리는 시간
+        :param max_size: 이 개수만큼 모이면 기다리지 않고 바로 보냄
+        """
+        self.underlying = underlying
+        # 캐시 키가 바뀌지 않도록 실제 모델 이름을 그대로 노출
+        self.model = getattr(underlying, "model", type(underlying).__name__)
+        self.window = window_ms / 1000
+        self.max_size = max_size
+
+        self._loop = None
+        self._pending = []      # (텍스트, future)
+        self._timer = None
+        self._tasks = set()
+
+        self.queries = 0
+        self.batches = 0
+        self.max_batch = 0
+        self.errors = 0
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.underlying.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        # 동기 호출(스레드에서 실행되는 로딩/검색)은 모으지 않고 바로 전달
+        return self.underlying.embed_query(text)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return await self.underlying.aembed_documents(texts)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # 이벤트 루프가 바뀌면 (테스트 등) 이전 루프의 대기 목록은 사용하지 않음
+            self._loop, self._pending, self._timer = loop, [], None
+
+        future = loop.create_future()
+        self._pending.append((text, future))
+        self.queries += 1
+
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        task = self._loop.create_task(self._run_batch(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_batch(self, batch):
+        # 같은 질문은 한 번만 임베딩
+        texts = list(dict.fromkeys(text for text, _ in batch))
+        self.batches += 1
+        self.max_batch = max(self.max_batch, len(texts))
+        try:
+            vectors = dict(zip(texts, await self.underlying.aembed_documents(texts)))
+        except Exception as e:
+            self.errors += 1
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for text, future in batch:
+            if not future.done():
+                future.set_result(vectors[text])
+
+    def stats(self) -> dict:
+        return {
+            "queries": self.queries,
+            "batches": self.batches,
+            "avg_batch_size": round(self.queries / self.batches, 2) if self.batches else 0.0,
+            "max_batch_size": self.max_batch,
+            "errors": self.errors,
+            "window_ms": self.window * 1000
+        }
@@ -0,0 +1,170 @@
+import asyncio
+import os
+import random
+import re
+import uuid
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional
+
+# 감정 코드 (emotion_analyzation_prompt 와 동일)
+EMOTION_NEUTRAL = 0
+EMOTION_HAPPY = 1
+EMOTION_SAD = 2
+
+# LLM 감정 분석을 응답 이후 비동기로 보정할지 여부와 보정할 응답 비율
+EMOTION_LLM_REFINE = os.getenv("EMOTION_LLM_REFINE", "false").lower() == "true"
+EMOTION_LLM_REFINE_RATE = float(os.getenv("EMOTION_LLM_REFINE_RATE", "0.2"))
+
+# 보정 결과를 보관할 최대 개수 (오래된 것부터 삭제)
+EMOTION_REFINE_MAX_RESULTS = int(os.getenv("EMOTION_REFINE_MAX_RESULTS", "10000"))
+
+HAPPY_WORDS = [
+    "기쁘", "기뻐", "기쁜", "행복", "신나", "신난", "신났", "즐거", "즐겁", "좋아", "좋은", "좋다", "좋군", "좋네",
+    "최고", "멋지", "멋진", "멋져", "재밌", "재미있", "사랑", "웃음", "웃겨", "고마", "감사", "축하", "설레", "대단",
+    "완벽", "훌륭", "환상", "만세", "야호", "와아", "우와", "하하", "ㅋㅋ", "ㅎㅎ", "^^", "😀", "😄", "😆", "😊", "🎉",
+]
+
+SAD_WORDS = [
+    "슬프", "슬퍼", "슬픈", "우울", "외로", "외롭", "괴로", "괴롭", "힘들", "힘든", "아프", "아파", "눈물", "울고", "울었",
+    "울어", "속상", "서럽", "서러", "미안", "죄송", "그립", "그리워", "후회", "절망", "실망", "비참", "불행", "걱정",
+    "두렵", "두려", "무서", "한심", "ㅠ", "ㅜ", "😢", "😭", "😞",
+]
+
+_HAPPY_PATTERN = re.compile("|".join(map(re.escape, HAPPY_WORDS)))
+_SAD_PATTERN = re.compile("|".join(map(re.escape, SAD_WORDS)))
+
+# "좋지 않아", "안 좋아", "행복하지 못해" 같은 부정 표현은 긍정 단어를 반대로 셈
+_NEGATED_HAPPY_PATTERN = re.compile(
+    r"(?:안|못)\s*(?:좋|기쁘|기뻐|행복|신나|즐거|즐겁|재밌)|(?:좋|기쁘|행복하|신나|즐겁|재밌)\w*지\s*(?:않|못|마)"
+)
+
+# "걱정하지 마", "안 아파", "슬퍼하지 않아도 돼" 같은 위로/부정 표현은 슬픔 단어를 세지 않음
+_SAD_STEMS = r"슬프|슬퍼|우울|외로|외롭|괴로|괴롭|힘들|아프|아파|속상|서럽|서러|미안|죄송|후회|절망|실망|걱정|두렵|두려|무서"
+_NEGATED_SAD_PATTERN = re.compile(
+    rf"(?:안|못)\s*(?:{_SAD_STEMS})|(?:{_SAD_STEMS})\w*지(?:도|는)?\s*(?:않|못|마|말)|걱정\s*(?:마|말|없)"
+)
+
+# "에스카노르: ..." 같은 이름 접두어
+_NAME_PREFIX_PATTERN = re.compile(r"^\s*[^\s:]{1,15}\s*:\s*")
+
+# 로컬 분류 결과 카운터 (감정 코드 -> 횟수)
+_emotion_counts = {EMOTION_NEUTRAL: 0, EMOTION_HAPPY: 0, EMOTION_SAD: 0}
+
+
+def classify_emotion(message: str) -> int:
+    """
+    한국어 감정 사전 기반 로컬 감정 분류 (LLM 호출 없음)
+    :param message: 캐릭터 메세지
+    :return: 1 (기쁨/신남), 2 (슬픔/우울), 0 (그 외)
+    """
+    if not message:
+        _emotion_counts[EMOTION_NEUTRAL] += 1
+        return EMOTION_NEUTRAL
+
+    text = _NAME_PREFIX_PATTERN.sub("", message, count=1)
+
+    happy = len(_HAPPY_PATTERN.findall(text))
+    sad = len(_SAD_PATTERN.findall(text))
+
+    negated = len(_NEGATED_HAPPY_PATTERN.findall(text))
+    happy -= negated
+    sad += negated
+
+    # 부정된 슬픔 단어는 빼기만 함 (위로하는 말이 슬픔으로 분류되지 않도록)
+    sad = max(0, sad - len(_NEGATED_SAD_PATTERN.findall(text)))
+
+    # 느낌표가 여러 번 나오면 들뜬 말투로 봄
+    if text.count("!") >= 2 and sad == 0:
+        happy += 1
+
+    if happy > sad and happy > 0:
+        emotion = EMOTION_HAPPY
+    elif sad > happy and sad > 0:
+        emotion = EMOTION_SAD
+    else:
+        emotion = EMOTION_NEUTRAL
+    _emotion_counts[emotion] += 1
+    return emotion
+
+
+class EmotionRefiner:
+    """
+    LLM 감정 분석을 응답 경로 밖에서 실행하고, 결과를 티켓으로 조회할 수 있도록 보관
+    """
+
+    def __init__(self, max_results: int = EMOTION_REFINE_MAX_RESULTS):
+        self.max_results = max_results
+        self._results = OrderedDict()   # ticket -> {"status": ..., "msg_img": ...}
+        self._tasks = set()
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.changed = 0    # LLM 결과가 로컬 분류와 달랐던 횟수
+
+    def submit(self, message: str, local_emotion: int, analyzer: Callable[[str], Awaitable[int]]) -> str:
+        """
+        :param message: 분석할 캐릭터 메세지
+        :param local_emotion: 응답과 함께 이미 보낸 로컬 분류 결과
+        :param analyzer: LLM 감정 분석 함수
+        :return: 결과 조회용 티켓
+        """
+        ticket = uuid.uuid4().hex
+        self.submitted += 1
+        self._results[ticket] = {"status": "pending", "msg_img": local_emotion}
+        while len(self._results) > self.max_results:
+            self._results.popitem(last=False)
+
+        task = asyncio.create_task(self._run(ticket, message, local_emotion, analyzer))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return ticket
+
+    async def _run(self, ticket: str, message: str, local_emotion: int, analyzer):
+        try:
+            msg_img = await analyzer(message)
+            self.completed += 1
+            if msg_img != local_emotion:
+                self.changed += 1
+            result = {"status": "done", "msg_img": msg_img}
+        except Exception as e:
+            # 실패하면 로컬 분류 결과를 그대로 유지
+            print(f"LLM 감정 분석 실패: {e}")
+            self.failed += 1
+            result = {"status": "failed", "msg_img": local_emotion}
+
+        if ticket in self._results:
+            self._results[ticket] = result
+
+    def get(self, ticket: str) -> Optional[dict]:
+        return self._results.get(ticket)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": EMOTION_LLM_REFINE,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "changed": self.changed,
+            "pending": len(self._tasks)
+        }
+
+
+emotion_refiner = EmotionRefiner()
+
+
+def refine_emotion(message: str, local_emotion: int, analyzer) -> Optional[str]:
+    """
+    설정된 비율만큼 LLM 감정 분석을 백그라운드로 요청
+    :return: 보정 결과 조회용 티켓 (요청하지 않았으면 None)
+    """
+    if not EMOTION_LLM_REFINE or random.random() >= EMOTION_LLM_REFINE_RATE:
+        return None
+    return emotion_refiner.submit(message, local_emotion, analyzer)
+
+
+def emotion_stats() -> dict:
+    return {
+        "local": {"neutral": _emotion_counts[EMOTION_NEUTRAL], "happy": _emotion_counts[EMOTION_HAPPY], "sad": _emotion_counts[EMOTION_SAD]},
+        "llm_refine": emotion_refiner.stats()
+    }
+
@@ -0,0 +1,184 @@
+import json
+import os
+import time
+from typing import List, Optional, Sequence, Tuple
+
+from langchain_core.messages import BaseMessage, message_to_dict, messages_from_dict
+
+# 활성 대화 히스토리를 둘 핫 티어 (none | redis | memory), memory 는 테스트/단일 프로세스용
+HISTORY_HOT_TIER = os.getenv("HISTORY_HOT_TIER", "none").lower()
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+# 마지막 접근 후 이 시간(초)이 지나면 핫 티어에서 제거되고, 다음 접근 때 SQL 에서 다시 불러옴
+HISTORY_HOT_TTL = int(os.getenv("HISTORY_HOT_TTL", "1800"))
+
+# 대화 하나가 핫 티어에 둘 수 있는 최대 메세지 수 (HISTORY_MAX_TURNS=0 이어도 무한히 늘어나지 않도록)
+HISTORY_HOT_MAX_MESSAGES = int(os.getenv("HISTORY_HOT_MAX_MESSAGES", "200"))
+
+# 대화가 핫 티어에 있을 때만 메세지를 추가하고 길이를 자른 뒤 TTL 갱신 (확인과 추가를 한 번에 처리)
+_APPEND_SCRIPT = """
+if redis.call('EXISTS', KEYS[2]) == 0 then
+    return 0
+end
+redis.call('RPUSH', KEYS[1], unpack(ARGV, 3))
+redis.call('LTRIM', KEYS[1], -tonumber(ARGV[2]), -1)
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+redis.call('EXPIRE', KEYS[2], ARGV[1])
+return 1
+"""
+
+_SET_SUMMARY_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'summary', ARGV[1])
+return 1
+"""
+
+
+def _dumps(messages: Sequence[BaseMessage]) -> List[str]:
+    return [json.dumps(message_to_dict(m), ensure_ascii=False) for m in messages]
+
+
+def _loads(items: Sequence) -> List[BaseMessage]:
+    return messages_from_dict([json.loads(item) for item in items])
+
+
+def hot_limit(max_len: int) -> int:
+    """
+    핫 티어에 남길 메세지 수
+    :param max_len: 대화 범위(HISTORY_MAX_TURNS * 2), 0 이면 범위 제한 없음
+    """
+    return min(max_len, HISTORY_HOT_MAX_MESSAGES) if max_len else HISTORY_HOT_MAX_MESSAGES
+
+
+class InMemoryHotStore:
+    """
+    프로세스 내부 핫 티어 (Redis 대신 테스트나 단일 워커에서 사용)
+    """
+
+    def __init__(self, ttl: int = HISTORY_HOT_TTL):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = {}     # key -> (만료 시각, summary, 메세지 리스트), 직렬화 없이 메세지 객체를 그대로 보관
+        self._last_sweep = time.monotonic()
+
+    def _alive(self, key: str):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self._data[key]
+            return None
+        return entry
+
+    async def get(self, key: str) -> Optional[Tuple[Optional[str], List[BaseMessage]]]:
+        entry = self._alive(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        _, summary, items = entry
+        self._data[key] = (time.monotonic() + self.ttl, summary, items)
+        return summary, list(items)
+
+    def _sweep(self):
+        # 접근이 끊긴 대화도 메모리에 남지 않도록 주기적으로 만료된 항목 제거
+        now = time.monotonic()
+        if now - self._last_sweep < 60:
+            return
+        self._last_sweep = now
+        for key in [k for k, entry in self._data.items() if entry[0] < now]:
+            del self._data[key]
+
+    async def hydrate(self, key: str, summary: Optional[str], messages: Sequence[BaseMessage], max_len: int):
+        self._sweep()
+        items = list(messages)[-hot_limit(max_len):]
+        self._data[key] = (time.monotonic() + self.ttl, summary, items)
+
+    async def append(self, key: str, messages: Sequence[BaseMessage], max_len: int):
+        # 핫 티어에 없는 대화는 일부만 캐시되지 않도록 추가하지 않음 (다음 접근 때 SQL 에서 불러옴)
+        entry = self._alive(key)
+        if entry is None:
+            return
+        _, summary, items = entry
+        items = (items + list(messages))[-hot_limit(max_len):]
+        self._data[key] = (time.monotonic() + self.ttl, summary, items)
+
+    async def set_summary(self, key: str, summary: str):
+        entry = self._alive(key)
+        if entry is not None:
+            self._data[key] = (entry[0], summary, entry[2])
+
+    def stats(self) -> dict:
+        return {"backend": "memory", "hits": self.hits, "misses": self.misses, "conversations": len(self._data)}
+
+
+class RedisHotStore:
+    """
+    Redis 핫 티어
+    대화별로 메세지 리스트(key)와 요약/적재 여부 해시(key:meta)를 두고, 접근할 때마다 TTL 을 갱신한다.
+    """
+
+    def __init__(self, url: str = REDIS_URL, ttl: int = HISTORY_HOT_TTL):
+        import redis.asyncio as aioredis
+
+        self.client = aioredis.from_url(url, decode_responses=True)
+        self._append_script = self.client.register_script(_APPEND_SCRIPT)
+        self._set_summary_script = self.client.register_script(_SET_SUMMARY_SCRIPT)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, key: str) -> Optional[Tuple[Optional[str], List[BaseMessage]]]:
+        # 읽기와 TTL 갱신을 한 번의 왕복으로 처리
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.hgetall(f"{key}:meta")
+            pipe.lrange(key, 0, -1)
+            pipe.expire(key, self.ttl)
+            pipe.expire(f"{key}:meta", self.ttl)
+            meta, items, _, _ = await pipe.execute()
+
+        if not meta:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return meta.get("summary") or None, _loads(items)
+
+    async def hydrate(self, key: str, summary: Optional[str], messages: Sequence[BaseMessage], max_len: int):
+        items = _dumps(messages)[-hot_limit(max_len):]
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.delete(key)
+            if items:
+                pipe.rpush(key, *items)
+            pipe.hset(f"{key}:meta", mapping={"summary": summary or "", "hydrated_at": time.time()})
+            pipe.expire(key, self.ttl)
+            pipe.expire(f"{key}:meta", self.ttl)
+            await pipe.execute()
+
+    async def append(self, key: str, messages: Sequence[BaseMessage], max_len: int):
+        # 핫 티어에 없는 대화는 일부만 캐시되지 않도록 추가하지 않음 (다음 접근 때 SQL 에서 불러옴)
+        # 확인과 추가 사이에 키가 만료되면 메타 없는 리스트가 생기므로 Lua 스크립트로 원자적으로 처리
+        if not messages:
+            return
+        await self._append_script(keys=[key, f"{key}:meta"], args=[self.ttl, hot_limit(max_len), *_dumps(messages)])
+
+    async def set_summary(self, key: str, summary: str):
+        await self._set_summary_script(keys=[f"{key}:meta"], args=[summary])
+
+    def stats(self) -> dict:
+        return {"backend": "redis", "hits": self.hits, "misses": self.misses}
+
+
+_hot_store = None
+
+
+def get_hot_store():
+    """
+    설정된 핫 티어 반환 (HISTORY_HOT_TIER=none 이면 None)
+    """
+    global _hot_store
+    if _hot_store is None and HISTORY_HOT_TIER != "none":
+        _hot_store = RedisHotStore() if HISTORY_HOT_TIER == "redis" else InMemoryHotStore()
+    return _hot_store
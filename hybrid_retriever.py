@@ -0,0 +1,192 @@
+import math
+import os
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+
+from langchain_core.callbacks import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStoreRetriever
+
+# 검색 방식 (vector: FAISS 만 | lexical: BM25 만, 질문 임베딩 호출 없음 | hybrid: 두 결과를 RRF 로 합침)
+# 기본은 기존과 같은 vector, hybrid/lexical 은 benchmarks/retrieval_modes.py 로 recall 을 확인한 뒤 설정으로 켬
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "vector").lower()
+
+# RRF 상수와, 합치기 전에 각 방식에서 가져올 후보 수 (k 의 배수)
+RETRIEVAL_RRF_K = int(os.getenv("RETRIEVAL_RRF_K", "60"))
+RETRIEVAL_CANDIDATE_MULTIPLIER = int(os.getenv("RETRIEVAL_CANDIDATE_MULTIPLIER", "3"))
+
+# BM25 파라미터
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+_WORD_PATTERN = re.compile(r"[가-힣]+|[a-z0-9]+|[ㄱ-ㅎㅏ-ㅣ]+")
+
+
+def tokenize_korean(text: str) -> List[str]:
+    """
+    한국어는 조사/어미가 붙어서 띄어쓰기 단위로는 잘 맞지 않으므로 한글 어절은 음절 bigram 으로 나눔
+    예: "게살버거를" -> ["게살", "살버", "버거", "거를"], 영문/숫자는 단어 그대로
+    """
+    tokens = []
+    for word in _WORD_PATTERN.findall((text or "").lower()):
+        if word[0] < "가" or len(word) == 1:
+            tokens.append(word)
+            continue
+        tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+    return tokens
+
+
+class BM25Index:
+    """
+    청크 리스트로 만드는 메모리 BM25 인덱스 (역색인)
+    """
+
+    def __init__(self, documents: List[Document], k1: float = BM25_K1, b: float = BM25_B):
+        self.documents = documents
+        self.k1 = k1
+        self.b = b
+
+        self._postings: Dict[str, List[Tuple[int, int]]] = defaultdict(list)    # 토큰 -> [(문서 번호, 빈도)]
+        self._lengths = []
+        for i, doc in enumerate(documents):
+            counts = Counter(tokenize_korean(doc.page_content))
+            self._lengths.append(sum(counts.values()))
+            for token, tf in counts.items():
+                self._postings[token].append((i, tf))
+
+        n = len(documents)
+        self._avg_length = (sum(self._lengths) / n) if n else 0.0
+        self._idf = {token: math.log(1 + (n - len(p) + 0.5) / (len(p) + 0.5)) for token, p in self._postings.items()}
+
+    def search(self, query: str, k: int) -> List[Tuple[Document, float]]:
+        scores = defaultdict(float)
+        for token in set(tokenize_korean(query)):
+            idf = self._idf.get(token)
+            if idf is None:
+                continue
+            for i, tf in self._postings[token]:
+                norm = self.k1 * (1 - self.b + self.b * self._lengths[i] / self._avg_length)
+                scores[i] += idf * tf * (self.k1 + 1) / (tf + norm)
+
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        return [(self.documents[i], score) for i, score in ranked]
+
+
+def reciprocal_rank_fusion(rankings: List[List[Document]], k: int, rrf_k: int = RETRIEVAL_RRF_K) -> List[Document]:
+    """
+    여러 검색 결과 순위를 RRF 로 합침 (같은 내용의 청크는 하나로 취급)
+    """
+    scores = defaultdict(float)
+    documents = {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking):
+            key = doc.page_content
+            scores[key] += 1.0 / (rrf_k + rank + 1)
+            documents.setdefault(key, doc)
+    ranked = sorted(scores, key=scores.get, reverse=True)[:k]
+    return [documents[key] for key in ranked]
+
+
+# 검색 방식별 지연시간 (mode -> [횟수, 누적 초])
+_timings = defaultdict(lambda: [0, 0.0])
+_timings_lock = threading.Lock()
+
+
+def _record_timing(mode: str, seconds: float):
+    with _timings_lock:
+        entry = _timings[mode]
+        entry[0] += 1
+        entry[1] += seconds
+
+
+def retrieval_stats() -> dict:
+    with _timings_lock:
+        return {
+            "mode": RETRIEVAL_MODE,
+            "latency_ms": {mode: {"count": count, "avg": round(total / count * 1000, 2)} for mode, (count, total) in _timings.items()}
+        }
+
+
+class HybridRetriever(VectorStoreRetriever):
+    """
+    FAISS 검색과 BM25 검색을 함께 쓰는 retriever
+    vectorstore / search_kwargs 는 기존 VectorStoreRetriever 와 같으므로 그대로 사용할 수 있다.
+    """
+
+    lexical_index: Any = None
+    mode: str = RETRIEVAL_MODE
+
+    def _k(self) -> int:
+        return self.search_kwargs.get("k", 4)
+
+    def _lexical(self, query: str, k: int) -> List[Document]:
+        return [doc for doc, _ in self.lexical_index.search(query, k)]
+
+    def _fuse(self, query: str, vector_docs: List[Document]) -> List[Document]:
+        k = self._k()
+        return reciprocal_rank_fusion([vector_docs, self._lexical(query, k * RETRIEVAL_CANDIDATE_MULTIPLIER)], k)
+
+    def _mode(self) -> str:
+        # BM25 인덱스가 없으면 벡터 검색만 사용
+        return self.mode if self.lexical_index is not None else "vector"
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun, **kwargs: Any) -> List[Document]:
+        mode = self._mode()
+        started = time.perf_counter()
+        if mode == "lexical":
+            docs = self._lexical(query, self._k())
+        elif mode == "hybrid":
+            candidates = self.vectorstore.similarity_search(query, k=self._k() * RETRIEVAL_CANDIDATE_MULTIPLIER)
+            docs = self._fuse(query, candidates)
+        else:
+            docs = super()._get_relevant_documents(query, run_manager=run_manager, **kwargs)
+        _record_timing(mode, time.perf_counter() - started)
+        return docs
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun, **kwargs: Any) -> List[Document]:
+        mode = self._mode()
+        started = time.perf_counter()
+        if mode == "lexical":
+            docs = self._lexical(query, self._k())
+        elif mode == "hybrid":
+            candidates = await self.vectorstore.asimilarity_search(query, k=self._k() * RETRIEVAL_CANDIDATE_MULTIPLIER)
+            docs = self._fuse(query, candidates)
+        else:
+            docs = await super()._aget_relevant_documents(query, run_manager=run_manager, **kwargs)
+        _record_timing(mode, time.perf_counter() - started)
+        return docs
+
+    def needs_query_vector(self) -> bool:
+        return self._mode() != "lexical"
+
+    def search_by_vector(self, query: str, query_vector: Optional[List[float]]) -> List[Document]:
+        """
+        이미 계산된 질문 임베딩으로 검색 (lexical 모드에서는 임베딩을 쓰지 않음)
+        """
+        mode = self._mode()
+        started = time.perf_counter()
+        if mode == "lexical" or query_vector is None:
+            docs = self._lexical(query, self._k())
+        elif mode == "hybrid":
+            candidates = self.vectorstore.similarity_search_by_vector(list(query_vector), k=self._k() * RETRIEVAL_CANDIDATE_MULTIPLIER)
+            docs = self._fuse(query, candidates)
+        else:
+            docs = self.vectorstore.similarity_search_by_vector(list(query_vector), **self.search_kwargs)
+        _record_timing(mode, time.perf_counter() - started)
+        return docs
+
+    async def asearch_by_vector(self, query: str, query_vector: Optional[List[float]]) -> List[Document]:
+        mode = self._mode()
+        started = time.perf_counter()
+        if mode == "lexical" or query_vector is None:
+            docs = self._lexical(query, self._k())
+        elif mode == "hybrid":
+            candidates = await self.vectorstore.asimilarity_search_by_vector(list(query_vector), k=self._k() * RETRIEVAL_CANDIDATE_MULTIPLIER)
+            docs = self._fuse(query, candidates)
+        else:
+            docs = await self.vectorstore.asimilarity_search_by_vector(list(query_vector), **self.search_kwargs)
+        _record_timing(mode, time.perf_counter() - started)
+        return docs
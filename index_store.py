@@ -0,0 +1,387 @@
+import hashlib
+import json
+import math
+import os
+import pickle
+import shutil
+import threading
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+import faiss
+import numpy as np
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+
+# 저장 포맷이 바뀌면 버전을 올려서 기존 인덱스를 모두 무효화
+INDEX_STORE_VERSION = 1
+
+# 인덱스 저장 경로 (캐릭터별 하위 폴더에 키 단위로 저장)
+INDEX_STORE_DIR = os.getenv("INDEX_STORE_DIR", "index_store")
+
+# 인덱스 종류 (flat: 전체 비교 | ivf: 클러스터 단위 검색 | hnsw: 그래프 검색)
+INDEX_BACKEND = os.getenv("INDEX_BACKEND", "flat").lower()
+
+# 벡터 저장 방식 (float32: 원본 | fp16: 절반 크기 | sq8: 1/4 크기 | pq: product quantization, 가장 작음)
+INDEX_STORAGE = os.getenv("INDEX_STORAGE", "float32").lower()
+
+# character: 캐릭터마다 인덱스 하나 | shared: 모든 캐릭터를 인덱스 하나에 넣고 캐릭터별 id 범위로 검색
+INDEX_LAYOUT = os.getenv("INDEX_LAYOUT", "character").lower()
+
+# 인덱스 파일을 메모리에 모두 올리지 않고 mmap 으로 열기 (실제로 읽힌 페이지만 메모리에 올라감)
+INDEX_MMAP = os.getenv("INDEX_MMAP", "true").lower() == "true"
+
+# 검색 파라미터 (ivf: 검색할 클러스터 수 | hnsw: 그래프 이웃 수, 검색 후보 수 | pq: 벡터당 바이트 수, 0 이면 차원/16)
+INDEX_IVF_NPROBE = int(os.getenv("INDEX_IVF_NPROBE", "8"))
+INDEX_HNSW_M = int(os.getenv("INDEX_HNSW_M", "32"))
+INDEX_HNSW_EF_SEARCH = int(os.getenv("INDEX_HNSW_EF_SEARCH", "64"))
+INDEX_PQ_M = int(os.getenv("INDEX_PQ_M", "0"))
+
+# PQ 코드북(256개 중심) 학습에 필요한 최소 벡터 수, IVF 클러스터당 최소 벡터 수
+_PQ_MIN_TRAIN = 256
+_IVF_MIN_PER_LIST = 39
+
+_STORAGE_CODES = {"float32": "Flat", "fp16": "SQfp16", "sq8": "SQ8"}
+
+
+def index_settings() -> dict:
+    return {"backend": INDEX_BACKEND, "storage": INDEX_STORAGE}
+
+
+def compute_index_key(documents: List[Document], chunker_settings: dict, model_name: str) -> str:
+    """
+    인덱스 키 계산: 원본 문서, 청커 설정, 임베딩 모델이 같으면 같은 키
+    :param documents: 청킹 전 원본 문서 리스트
+    :param chunker_settings: SemanticChunker 설정
+    :param model_name: 임베딩 모델 이름
+    :return: 인덱스 키 (sha256 hex)
+    """
+    digest = hashlib.sha256()
+    header = {
+        "version": INDEX_STORE_VERSION,
+        "chunker": chunker_settings,
+        "model": model_name,
+    }
+    # 기본 설정(flat/float32)이면 키에 넣지 않아서 기존에 저장된 인덱스를 그대로 사용
+    if index_settings() != {"backend": "flat", "storage": "float32"}:
+        header["index"] = index_settings()
+    digest.update(json.dumps(header, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+    for doc in documents:
+        digest.update(doc.page_content.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def _pq_m(dim: int) -> int:
+    # PQ 는 차원을 m 개로 나눠서 각각 1바이트로 저장하므로 m 이 차원의 약수여야 함
+    m = min(INDEX_PQ_M or max(1, dim // 16), dim)
+    while dim % m:
+        m -= 1
+    return m
+
+
+def factory_string(dim: int, count: int, backend: str = None, storage: str = None) -> str:
+    """
+    설정에 맞는 faiss index_factory 문자열
+    벡터가 너무 적어서 학습할 수 없는 설정이면 가까운 설정으로 바꿈 (캐릭터 자료가 작은 경우)
+    :param dim: 벡터 차원
+    :param count: 인덱스에 넣을 벡터 수
+    :param backend: flat / ivf / hnsw (없으면 INDEX_BACKEND)
+    :param storage: float32 / fp16 / sq8 / pq (없으면 INDEX_STORAGE)
+    """
+    backend = backend or INDEX_BACKEND
+    storage = storage or INDEX_STORAGE
+
+    if storage == "pq" and count < _PQ_MIN_TRAIN:
+        print(f"벡터 {count}개로는 PQ 를 학습할 수 없어서 fp16 으로 저장합니다.")
+        storage = "fp16"
+    code = f"PQ{_pq_m(dim)}" if storage == "pq" else _STORAGE_CODES.get(storage, "Flat")
+
+    if backend == "hnsw":
+        return f"HNSW{INDEX_HNSW_M}" if code == "Flat" else f"HNSW{INDEX_HNSW_M}_{code}"
+    if backend == "ivf":
+        nlist = max(1, min(int(4 * math.sqrt(count)), count // _IVF_MIN_PER_LIST))
+        return f"IVF{nlist},{code}"
+    # IndexPQ 는 검색 시 id 범위 지정(공유 인덱스)을 지원하지 않으므로 클러스터 1개짜리 IVF 로 만듦 (전체 비교와 같음)
+    return f"IVF1,{code}" if storage == "pq" else code
+
+
+def _configure(index):
+    # 검색 파라미터는 인덱스 파일에 저장되지 않으므로 만들거나 읽을 때마다 설정
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.nprobe = min(INDEX_IVF_NPROBE, ivf.nlist)
+    if isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = INDEX_HNSW_EF_SEARCH
+    return index
+
+
+def search_parameters(index, selector=None):
+    """
+    id 범위 제한 등 검색 옵션 (ivf/hnsw 는 파라미터 객체를 넘기면 인덱스 설정 대신 이 값이 쓰이므로 같이 지정)
+    """
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        return faiss.SearchParametersIVF(sel=selector, nprobe=ivf.nprobe)
+    if isinstance(index, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=index.hnsw.efSearch)
+    return faiss.SearchParameters(sel=selector)
+
+
+def build_faiss_index(vectors: np.ndarray, backend: str = None, storage: str = None):
+    """
+    벡터로 faiss 인덱스 생성 (학습이 필요한 설정이면 같은 벡터로 학습)
+    :param vectors: (개수, 차원) float32 배열
+    """
+    count, dim = vectors.shape
+    index = faiss.index_factory(dim, factory_string(dim, count, backend, storage), faiss.METRIC_L2)
+    if not index.is_trained:
+        index.train(vectors)
+    index.add(vectors)
+
+    # 라우터의 지식 베이스 중심 벡터 계산(reconstruct_n)을 위해 IVF 도 id 로 벡터를 찾을 수 있게 함
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.make_direct_map()
+    return _configure(index)
+
+
+def build_vectorstore(chunks: List[Document], embeddings, vectors: Optional[List[List[float]]] = None) -> FAISS:
+    """
+    청크로 FAISS 벡터스토어 생성 (INDEX_BACKEND / INDEX_STORAGE 설정 사용, flat/float32 는 FAISS.from_documents 와 같음)
+    :param chunks: 청크 리스트
+    :param embeddings: 청크/질문 임베딩에 사용할 임베딩 객체
+    :param vectors: 이미 계산된 청크 임베딩 (없으면 계산)
+    """
+    if vectors is None:
+        vectors = embeddings.embed_documents([c.page_content for c in chunks])
+    index = build_faiss_index(np.array(vectors, dtype=np.float32))
+
+    ids = [str(uuid.uuid4()) for _ in chunks]
+    docstore = InMemoryDocstore(dict(zip(ids, chunks)))
+    return FAISS(embeddings, index, docstore, dict(enumerate(ids)))
+
+
+def _read_faiss_index(path: str):
+    if INDEX_MMAP:
+        # IO_FLAG_MMAP 은 IVF 목록만, IO_FLAG_MMAP_IFC 는 flat/hnsw 벡터 저장소까지 mmap (faiss 1.8 이상)
+        flag = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP)
+        try:
+            return _configure(faiss.read_index(path, flag))
+        except RuntimeError as e:
+            print(f"인덱스를 mmap 으로 열 수 없어서 메모리로 읽습니다({path}): {e}")
+    return _configure(faiss.read_index(path))
+
+
+def _load_vectorstore(path: str, embeddings) -> FAISS:
+    # FAISS.load_local 과 같은 파일 구성(index.faiss, index.pkl)을 읽되 인덱스는 mmap 으로 엶
+    index = _read_faiss_index(os.path.join(path, "index.faiss"))
+    with open(os.path.join(path, "index.pkl"), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    return FAISS(embeddings, index, docstore, index_to_docstore_id)
+
+
+def _character_dir(character_id: int) -> str:
+    return os.path.join(INDEX_STORE_DIR, f"character_{character_id}")
+
+
+def _index_dir(character_id: int, key: str) -> str:
+    return os.path.join(_character_dir(character_id), key)
+
+
+def latest_index_key(character_id: int) -> Optional[str]:
+    """
+    저장 완료된 인덱스 중 가장 최근 키 (벤치마크 등 원본 문서 없이 인덱스를 열 때 사용)
+    """
+    character_dir = _character_dir(character_id)
+    if not os.path.isdir(character_dir):
+        return None
+    keys = [
+        name for name in os.listdir(character_dir)
+        if ".tmp-" not in name and os.path.exists(os.path.join(character_dir, name, "meta.json"))
+    ]
+    if not keys:
+        return None
+
+    def rank(name):
+        # 원본 문서를 모두 불러와서 만든 인덱스를 우선 (meta 의 complete, 없으면 완전한 것으로 봄)
+        path = os.path.join(character_dir, name, "meta.json")
+        try:
+            with open(path, encoding="utf-8") as f:
+                complete = json.load(f).get("complete", True)
+        except (OSError, ValueError):
+            complete = False
+        return complete, os.path.getmtime(path)
+
+    return max(keys, key=rank)
+
+
+def load_index(character_id: int, key: str, embeddings) -> Optional[Tuple[FAISS, List[Document]]]:
+    """
+    저장된 인덱스 로드
+    :param character_id: 캐릭터 id
+    :param key: compute_index_key 로 계산한 키
+    :param embeddings: 검색 시 질문 임베딩에 사용할 임베딩 객체
+    :return: (vectorstore, 청크 리스트), 저장된 인덱스가 없으면 None
+    """
+    path = _index_dir(character_id, key)
+
+    # meta.json 은 저장 마지막 단계에서 쓰므로, 없으면 저장이 끝나지 않은 인덱스
+    if not os.path.exists(os.path.join(path, "meta.json")):
+        return None
+
+    try:
+        vectorstore = _load_vectorstore(path, embeddings)
+        with open(os.path.join(path, "chunks.json"), encoding="utf-8") as f:
+            chunks = [Document(page_content=c["page_content"], metadata=c["metadata"]) for c in json.load(f)]
+    except Exception as e:
+        print(f"저장된 인덱스를 불러올 수 없습니다({path}): {e}")
+        return None
+
+    return vectorstore, chunks
+
+
+def save_index(character_id: int, key: str, vectorstore: FAISS, chunks: List[Document], meta: Optional[dict] = None, prune: bool = True):
+    """
+    인덱스를 디스크에 저장하고, 같은 캐릭터의 이전 버전 인덱스는 삭제
+    :param character_id: 캐릭터 id
+    :param key: compute_index_key 로 계산한 키
+    :param vectorstore: 저장할 FAISS 벡터스토어
+    :param chunks: 벡터스토어를 만든 청크 리스트
+    :param meta: 함께 기록할 부가 정보
+    :param prune: 이전 버전 인덱스 삭제 여부 (일부 문서만으로 만든 인덱스면 False)
+    """
+    path = _index_dir(character_id, key)
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+
+    # 임시 폴더에 모두 쓴 뒤 rename 해서, 다른 프로세스가 반쯤 쓰인 인덱스를 읽지 않도록 함
+    vectorstore.save_local(tmp_path)
+    with open(os.path.join(tmp_path, "chunks.json"), "w", encoding="utf-8") as f:
+        json.dump(
+            [{"page_content": c.page_content, "metadata": c.metadata} for c in chunks],
+            f,
+            ensure_ascii=False,
+        )
+    with open(os.path.join(tmp_path, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(
+            {"version": INDEX_STORE_VERSION, "character_id": character_id, "key": key, **(meta or {})},
+            f,
+            ensure_ascii=False,
+        )
+
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        # 다른 워커가 먼저 같은 키로 저장한 경우
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+    if prune:
+        _prune_old_indexes(character_id, key)
+
+
+def _prune_old_indexes(character_id: int, keep_key: str):
+    character_dir = _character_dir(character_id)
+    for name in os.listdir(character_dir):
+        if name == keep_key or ".tmp-" in name:
+            continue
+        shutil.rmtree(os.path.join(character_dir, name), ignore_errors=True)
+
+
+class CharacterIndexView(FAISS):
+    """
+    공유 인덱스(INDEX_LAYOUT=shared)에서 한 캐릭터의 id 범위만 검색하는 vectorstore
+    인덱스/문서 저장소는 모든 캐릭터가 함께 쓰고, 검색할 때 faiss IDSelectorRange 로 범위를 제한한다.
+    """
+
+    def __init__(self, shared: FAISS, character_id: int, start: int, end: int):
+        super().__init__(shared.embedding_function, shared.index, shared.docstore, shared.index_to_docstore_id)
+        self.character_id = character_id
+        self.id_range = (start, end)
+        self._selector = faiss.IDSelectorRange(start, end)    # 파라미터 객체가 참조하므로 함께 보관
+        self._search_params = search_parameters(self.index, self._selector)
+
+    def similarity_search_with_score_by_vector(self, embedding: List[float], k: int = 4, filter=None, fetch_k: int = 20, **kwargs) -> List[Tuple[Document, float]]:
+        vector = np.array([embedding], dtype=np.float32)
+        scores, indices = self.index.search(vector, k if filter is None else fetch_k, params=self._search_params)
+        filter_func = self._create_filter_func(filter) if filter is not None else None
+
+        docs = []
+        for score, i in zip(scores[0], indices[0]):
+            if i == -1:
+                continue
+            doc = self.docstore.search(self.index_to_docstore_id[i])
+            if filter_func is None or filter_func(doc.metadata):
+                docs.append((doc, score))
+        return docs[:k]
+
+
+_SHARED_LOCK = threading.Lock()
+
+
+def _shared_dir() -> str:
+    return os.path.join(INDEX_STORE_DIR, "shared")
+
+
+def _save_shared_index(path: str, shared_key: str, sources: Dict[int, Tuple[str, List[Document]]], embeddings):
+    chunks, ranges = [], {}
+    for character_id in sorted(sources):
+        character_chunks = sources[character_id][1]
+        ranges[str(character_id)] = [len(chunks), len(chunks) + len(character_chunks)]
+        chunks.extend(
+            Document(page_content=c.page_content, metadata={**c.metadata, "character_id": character_id})
+            for c in character_chunks
+        )
+    shared = build_vectorstore(chunks, embeddings)
+
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    shared.save_local(tmp_path)
+    with open(os.path.join(tmp_path, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump({"version": INDEX_STORE_VERSION, "key": shared_key, "index": index_settings(), "ranges": ranges}, f)
+
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        # 다른 워커가 먼저 같은 키로 저장한 경우
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+    for name in os.listdir(_shared_dir()):
+        if name != shared_key and ".tmp-" not in name:
+            shutil.rmtree(os.path.join(_shared_dir(), name), ignore_errors=True)
+    print("공유 인덱스 생성 완료 ( 캐릭터", len(ranges), "명, 청크", len(chunks), "개 )")
+
+
+def load_or_build_shared_index(sources: Dict[int, Tuple[str, List[Document]]], embeddings) -> Dict[int, CharacterIndexView]:
+    """
+    여러 캐릭터의 청크를 인덱스 하나로 합침 (캐릭터 인덱스 키가 모두 같으면 저장된 공유 인덱스를 재사용)
+    캐릭터별 청크는 연속된 id 범위에 들어가므로 id 범위로 캐릭터를 구분한다.
+    :param sources: character_id -> (캐릭터 인덱스 키, 청크 리스트)
+    :param embeddings: 청크/질문 임베딩에 사용할 임베딩 객체 (캐릭터 인덱스를 만들 때 캐시된 임베딩을 재사용)
+    :return: character_id -> 캐릭터별 vectorstore
+    """
+    digest = hashlib.sha256()
+    digest.update(json.dumps(
+        {"version": INDEX_STORE_VERSION, "index": index_settings(), "characters": {str(cid): key for cid, (key, _) in sources.items()}},
+        sort_keys=True,
+    ).encode("utf-8"))
+    shared_key = digest.hexdigest()
+    path = os.path.join(_shared_dir(), shared_key)
+
+    with _SHARED_LOCK:
+        if not os.path.exists(os.path.join(path, "meta.json")):
+            _save_shared_index(path, shared_key, sources, embeddings)
+        else:
+            print("공유 인덱스 사용 (", shared_key[:12], ")")
+
+        # 만든 직후에도 파일에서 다시 열어서 mmap 으로 사용
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+            ranges = json.load(f)["ranges"]
+        shared = _load_vectorstore(path, embeddings)
+
+    return {int(character_id): CharacterIndexView(shared, int(character_id), start, end) for character_id, (start, end) in ranges.items()}
+
@@ -1,29 +1,88 @@
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
 from langchain_openai import ChatOpenAI
-from chat_logic import get_or_load_retriever, setup_chat_chain, setup_balanceChat_chain, emotion_analyzation_prompt, setup_character_matching_prompt, setup_chat_chain, setup_balanceChat_chain
-from models import BalanceChatRequest, CharacterMatchResponse, ChatRequest, ChatResponse, LoadInfoRequest, CharacterMatchRequest, ChatRequest, ChatResponse
+from chat_logic import embeddings, embedding_coalescer, retrieval_cache, get_or_load_retriever, build_chain_registry, get_chat_chain, get_balance_chat_chain, get_group_chat_chain, get_chat_message_history, aretrieve_by_vector, needs_query_vector, use_shared_index, emotion_analyzation_prompt, CHARACTER_DESCRIPTIONS, CHARACTER_RETRIEVERS
+from character_router import character_router
+from hybrid_retriever import retrieval_stats
+from context_packing import packing_stats
+from prompt_cache import prompt_cache_stats
+from retrieval_gate import retrieval_gate
+from models import BalanceChatRequest, CharacterMatchResponse, ChatRequest, ChatResponse, LoadInfoRequest, CharacterMatchRequest, GroupChatRequest, ChatRequest, ChatResponse
+from langchain_core.messages import AIMessage, HumanMessage
 from contextlib import asynccontextmanager
-from TTS import TTS
-from sqlalchemy import create_engine
+from TTS import TTS, TTS_CHUNK_CONCURRENCY
+from db import dispose_engines, pool_stats
+from chat_history import history_writer
+from hot_history import get_hot_store
+from emotion import classify_emotion, refine_emotion, emotion_refiner, emotion_stats
+from concurrent.futures import ThreadPoolExecutor, wait
+from index_store import INDEX_LAYOUT
+import asyncio
+import base64
+import json
 import os
 import re
-import random
+
+CHARACTER_IDS = [1, 2, 3, 4, 5, 6]
+
+# 캐릭터 로딩(PDF/웹/임베딩)을 동시에 돌릴 워커 수
+WARMUP_WORKERS = int(os.getenv("WARMUP_WORKERS", "3"))
+
+# 캐릭터별 로딩 작업 (character_id -> Future)
+warmup_futures = {}
+
+def _switch_to_shared_index():
+    wait(list(warmup_futures.values()))
+    use_shared_index()
 
 def init():
-    for char_id in [1, 2, 3, 4, 5, 6]:
-        get_or_load_retriever(char_id)
+    # 서버 시작을 막지 않도록 백그라운드 스레드 풀에서 캐릭터를 동시에 로드
+    executor = ThreadPoolExecutor(max_workers=WARMUP_WORKERS, thread_name_prefix="warmup")
+    for char_id in CHARACTER_IDS:
+        warmup_futures[char_id] = executor.submit(get_or_load_retriever, char_id)
+
+    # 공유 인덱스 사용 시 모든 캐릭터 로딩이 끝난 뒤 하나로 합침
+    if INDEX_LAYOUT == "shared":
+        executor.submit(_switch_to_shared_index)
+
+    # 캐릭터별 체인은 한 번만 만들어서 요청마다 재사용
+    build_chain_registry(CHARACTER_IDS)
+    return executor
+
+async def wait_for_character(character_id: int):
+    # 해당 캐릭터가 아직 로딩 중이면 그 캐릭터의 로딩만 기다림
+    future = warmup_futures.get(character_id)
+    if future is not None and not future.done():
+        # 요청이 취소돼도(클라이언트 연결 끊김) 여러 요청이 공유하는 로딩 작업은 취소되지 않도록 shield
+        await asyncio.shield(asyncio.wrap_future(future))
+
+def get_character_status(character_id: int) -> str:
+    # 워밍업이 실패했어도 이후 요청에서 로드에 성공했으면 ready (로드된 retriever 기준)
+    if character_id in CHARACTER_RETRIEVERS:
+        return "ready"
+    future = warmup_futures.get(character_id)
+    if future is None:
+        return "not_scheduled"
+    if not future.done():
+        return "loading"
+    return "failed"
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    init()
+    executor = init()
+    # 단체방 라우팅에 쓰는 캐릭터 설명 임베딩은 백그라운드에서 미리 계산
+    router_warmup = asyncio.create_task(character_router.warm(CHARACTER_IDS))
     yield
+    router_warmup.cancel()
+    executor.shutdown(wait=False, cancel_futures=True)
+    await history_writer.stop()
+    await tts.aclose()
+    await dispose_engines()
 
 app = FastAPI(lifespan=lifespan)
 
 os.environ['KMP_DUPLICATE_LIB_OK']='True'
-DATABASE_URL = os.getenv("ENV_CONNECTION")
-engine = create_engine(DATABASE_URL)
 
 # CORS middleware
 app.add_middleware(
@@ -34,11 +93,40 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# 캐릭터별 로딩 상태
+@app.get("/ready")
+async def ready():
+    characters = {char_id: get_character_status(char_id) for char_id in CHARACTER_IDS}
+    return {
+        "ready": all(status == "ready" for status in characters.values()),
+        "characters": characters
+    }
+
+# 캐시 등 내부 지표
+@app.get("/metrics")
+async def metrics():
+    return {
+        "embedding_cache": embeddings.stats(),
+        "embedding_batching": embedding_coalescer.stats(),
+        "retrieval_cache": retrieval_cache.stats(),
+        "retrieval": retrieval_stats(),
+        "retrieval_gate": retrieval_gate.stats(),
+        "context_packing": packing_stats.stats(),
+        "prompt_cache": prompt_cache_stats.stats(),
+        "db_pool": pool_stats(),
+        "history_write_behind": history_writer.stats(),
+        "history_hot_tier": get_hot_store().stats() if get_hot_store() else None,
+        "tts_cache": tts.cache.stats(),
+        "emotion": emotion_stats(),
+        "character_router": character_router.stats()
+    }
+
 # 캐릭터와 채팅
 @app.post("/chat", response_model=ChatResponse)
 async def chat(request: ChatRequest):
     try:
-        chat_chain = setup_chat_chain(request.character_id)
+        await wait_for_character(request.character_id)
+        chat_chain = get_chat_chain(request.character_id)
         
         config = {
             "configurable": {
@@ -47,37 +135,85 @@ async def chat(request: ChatRequest):
             }
         }
 
-        response = chat_chain.invoke({"question": request.question}, config)
+        response = await chat_chain.ainvoke({"question": request.question}, config)
         
-        # 토큰 단위 스트리밍
-        # response = ""
-        # for token in chat_chain.stream({"question": request.question}, config):
-        #     # 스트림에서 받은 데이터의 내용을 출력
-        #     # 줄바꿈 없이 이어서 출력, 버퍼를 즉시 비움
-        #     response = response + token
-        #     print(token, end="", flush=True)
-
-        # 메세지 감정 분석
-        msg_img = 0
-        if random.random() < 0.2:   # 20% 확률로 캐릭터 메세지 감정 분석 (happy / sad / neither)
-            msg_img = analyze_emotion(response)
-            # print("메세지 감정분석 결과: ", msg_img)
+        # 토큰 단위 스트리밍은 /chat/stream 사용
+
+        # 메세지 감정 분석 (로컬 분류, LLM 분석은 설정 시 백그라운드로 보정하고 /chat/emotion/{ticket} 으로 조회)
+        msg_img = classify_emotion(response)
+        emotion_ticket = refine_emotion(response, msg_img, analyze_emotion)
 
         return ChatResponse(
             answer=response,
             character_id=request.character_id,
             msg_img=msg_img,
+            emotion_ticket=emotion_ticket,
             tts_url="/chat/stream_audio"
         )
     
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-def analyze_emotion(message: str):
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+async def stream_chat_events(http_request: Request, chat_chain, question: str, config: dict, character_id: int, analyze: bool):
+    """
+    체인의 토큰을 SSE 이벤트로 전달
+    스트림이 끝까지 완료되면 RunnableWithMessageHistory 가 히스토리에 최종 메세지를 저장한다.
+    :param analyze: 완료 후 감정 분석 여부 (/chat 과 동일하게 로컬 분류 + 선택적 LLM 보정)
+    """
+    stream = chat_chain.astream({"question": question}, config)
+    answer = ""
+    try:
+        async for token in stream:
+            if await http_request.is_disconnected():
+                print("클라이언트 연결이 끊어져 스트리밍을 중단합니다. character_id:", character_id)
+                return
+            answer += token
+            yield sse_event("token", {"token": token})
+
+        msg_img = 0
+        emotion_ticket = None
+        if analyze:
+            msg_img = classify_emotion(answer)
+            emotion_ticket = refine_emotion(answer, msg_img, analyze_emotion)
+
+        yield sse_event("done", {"answer": answer, "character_id": character_id, "msg_img": msg_img, "emotion_ticket": emotion_ticket})
+    except Exception as e:
+        yield sse_event("error", {"detail": str(e)})
+    finally:
+        # 중간에 끊겨도 업스트림(OpenAI) 스트림을 닫아서 요청이 남지 않도록 함
+        await stream.aclose()
+
+# 캐릭터와 채팅 (토큰 스트리밍, SSE)
+@app.post("/chat/stream")
+async def chat_stream(request: ChatRequest, http_request: Request):
+    try:
+        await wait_for_character(request.character_id)
+        chat_chain = get_chat_chain(request.character_id)
+
+        config = {
+            "configurable": {
+                "user_id": request.user_id,
+                "conversation_id": request.conversation_id
+            }
+        }
+
+        return StreamingResponse(
+            stream_chat_events(http_request, chat_chain, request.question, config, request.character_id, analyze=True),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+async def analyze_emotion(message: str):
     try:
         prompt = emotion_analyzation_prompt()
         llm = ChatOpenAI(model="gpt-4o-mini", temperature=0.1)
-        result = llm.invoke(
+        result = await llm.ainvoke(
             prompt.format(message=message)
         )
 
@@ -88,50 +224,106 @@ def analyze_emotion(message: str):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# LLM 감정 분석 보정 결과 조회
+@app.get("/chat/emotion/{ticket}")
+async def get_emotion(ticket: str):
+    result = emotion_refiner.get(ticket)
+    if result is None:
+        raise HTTPException(status_code=404, detail="존재하지 않거나 만료된 티켓입니다.")
+    return {"ticket": ticket, **result}
+
 # 단체방에서 사용자가 질문을 받아 어떤 캐릭터가 응답하기에 적합한지 결정하여 캐릭터id 리스트 반환
+# 임베딩 유사도로 먼저 고르고, 점수가 애매할 때만 LLM 으로 판단 (ROUTER_MODE)
 @app.post("/character/match", response_model=CharacterMatchResponse)
 async def match_character(request: CharacterMatchRequest):
     try:
-        question = request.question
-        char_id_list = request.char_id_list
-        chat_history_list = request.chat_history_list
-
-        formatted_chat_history = "\n".join(chat_history_list)
-
-        character_info = [
-            f"{char_id}: {get_character_info_by_id(char_id)}"
-            for char_id in char_id_list
-        ]
-        formatted_character_info = "\n".join(character_info)
-        
-        prompt = setup_character_matching_prompt()
-        llm = ChatOpenAI(model="gpt-4o-mini", temperature=0.1)
-        
-        result = llm.invoke(
-            prompt.format(question=question, chat_history=formatted_chat_history, character_info=formatted_character_info)
-        )
+        result = await character_router.route(request.question, request.char_id_list, request.chat_history_list)
 
-        # 캐릭터 ID 리스트로 반환
-        numeric_ids = re.findall(r'\b\d+\b', result.content)    # 숫자(정수)만 추출
-        matching_characters = [int(char_id) for char_id in numeric_ids]
-        
         return CharacterMatchResponse(
-            selected_char_id_list=matching_characters
+            selected_char_id_list=result["selected_char_id_list"],
+            confidence=result["confidence"],
+            method=result["method"]
         )
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-def get_character_info_by_id(character_id: int) -> str:
-    character_descriptions = {
-        6: "스폰지밥 (SpongeBob SquarePants) - A cheerful sea sponge living in 비키니 시티, loves jellyfishing and working at the 집게리아. (From *SpongeBob SquarePants*)",
-        5: "플랑크톤 (Plankton) - A scheming microbe from 비키니 시티 who often plots to steal the 게살버거 formula. (From *SpongeBob SquarePants*)",
-        1: "버즈 (Buzz Lightyear) - A space ranger toy from the *Toy Story* universe, brave and adventurous. (From *Toy Story*)",
-        4: "김전일 (Kindaichi) - A high school detective with exceptional reasoning skills, often solving complex murder cases. (From *Kindaichi Case Files*)",
-        3: "리바이 (Levi Ackerman) - A skilled soldier and captain of the Survey Corps from *Attack on Titan*, known for his agility, precision, and cold demeanor.",
-        2: "에스카노르 (Escanor) - The Lion's Sin of Pride from *Seven Deadly Sins*, confident and powerful during the day, timid at night."
-    }
-    return character_descriptions.get(character_id, f"존재하지 않는 캐릭터 번호: {character_id}")
+async def group_chat_events(http_request: Request, request: GroupChatRequest):
+    """
+    단체방 질문에 답할 캐릭터를 고르고, 선택된 캐릭터들의 답변을 동시에 생성해서 하나의 SSE 스트림으로 전달
+    히스토리 읽기와 질문 임베딩은 한 번만 하고 모든 캐릭터가 공유한다. 이벤트는 character_id 로 구분한다.
+    """
+    try:
+        route = await character_router.route(request.question, request.char_id_list, request.chat_history_list)
+        # 방에 있는 캐릭터만 답하도록 요청한 캐릭터 목록과 다시 교차
+        room = set(request.char_id_list)
+        selected = [char_id for char_id in dict.fromkeys(route["selected_char_id_list"])
+                    if char_id in room and char_id in CHARACTER_DESCRIPTIONS]
+        yield sse_event("match", {"selected_char_id_list": selected, "confidence": route["confidence"], "method": route["method"]})
+        if not selected:
+            yield sse_event("end", {"character_ids": []})
+            return
+
+        # 라우터에서 이미 계산한 질문 임베딩이 있으면 그대로 사용, 검색에 임베딩이 필요 없으면 계산하지 않음
+        history = get_chat_message_history(request.conversation_id)
+        query_vector = route["query_vector"]
+        if query_vector is None and needs_query_vector(selected, request.question):
+            chat_message, query_vector = await asyncio.gather(history.aget_messages(), embeddings.aembed_query(request.question))
+        else:
+            chat_message = await history.aget_messages()
+    except Exception as e:
+        yield sse_event("error", {"detail": str(e)})
+        return
+
+    events = asyncio.Queue()
+    answers = {}    # 완료된 순서대로 character_id -> 답변
+
+    async def generate(char_id: int):
+        try:
+            await wait_for_character(char_id)
+            relevant_info = await aretrieve_by_vector(char_id, request.question, query_vector)
+            chain = get_group_chat_chain(char_id)
+            answer = ""
+            async for token in chain.astream({"question": request.question, "chat_message": chat_message, "relevant_info": relevant_info}):
+                answer += token
+                await events.put(sse_event("token", {"character_id": char_id, "token": token}))
+
+            answers[char_id] = answer
+            await events.put(sse_event("done", {"character_id": char_id, "answer": answer, "msg_img": classify_emotion(answer)}))
+        except Exception as e:
+            await events.put(sse_event("error", {"character_id": char_id, "detail": str(e)}))
+        finally:
+            await events.put(None)
+
+    tasks = [asyncio.create_task(generate(char_id)) for char_id in selected]
+    try:
+        finished = 0
+        while finished < len(tasks):
+            event = await events.get()
+            if event is None:
+                finished += 1
+                continue
+            if await http_request.is_disconnected():
+                print("클라이언트 연결이 끊어져 단체방 스트리밍을 중단합니다. conversation_id:", request.conversation_id)
+                return
+            yield event
+
+        # 질문은 한 번, 답변은 완료된 순서대로 저장
+        if answers:
+            await history.aadd_messages([HumanMessage(content=request.question)] + [AIMessage(content=answer) for answer in answers.values()])
+        yield sse_event("end", {"character_ids": list(answers)})
+    finally:
+        for task in tasks:
+            task.cancel()
+
+# 단체방 채팅 (캐릭터 매칭 후 선택된 캐릭터들이 동시에 답변, SSE)
+@app.post("/groupChat/stream")
+async def group_chat_stream(request: GroupChatRequest, http_request: Request):
+    return StreamingResponse(
+        group_chat_events(http_request, request),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 global_situation = {}
 
@@ -143,17 +335,21 @@ async def balance_chat(request: BalanceChatRequest):
             global_situation[request.character_id] = request.situation
             current_situation = request.situation  # 상황 업데이트
         
-        # 챗 체인 설정
-        chat_chain = setup_balanceChat_chain(request.character_id, request.keyword, current_situation)
+        await wait_for_character(request.character_id)
+
+        # 챗 체인 (키워드/상황은 요청마다 config 로 전달)
+        chat_chain = get_balance_chat_chain(request.character_id)
 
         config = {
             "configurable": {
                 "user_id": request.user_id,
-                "conversation_id": request.conversation_id
+                "conversation_id": request.conversation_id,
+                "keyword": request.keyword,
+                "situation": current_situation
             }
         }
 
-        response = chat_chain.invoke({"question": request.question}, config)
+        response = await chat_chain.ainvoke({"question": request.question}, config)
 
         msg_img = 0
         # if random.random() < 0.2:   # 20% 확률로 캐릭터 메세지 감정 분석 (happy / sad / neither)
@@ -170,16 +366,170 @@ async def balance_chat(request: BalanceChatRequest):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# 밸런스 게임 채팅 (토큰 스트리밍, SSE)
+@app.post("/balanceChat/stream")
+async def balance_chat_stream(request: BalanceChatRequest, http_request: Request):
+    try:
+        current_situation = global_situation.get(request.character_id)
+        if request.situation:
+            global_situation[request.character_id] = request.situation
+            current_situation = request.situation  # 상황 업데이트
+
+        await wait_for_character(request.character_id)
+        chat_chain = get_balance_chat_chain(request.character_id)
+
+        config = {
+            "configurable": {
+                "user_id": request.user_id,
+                "conversation_id": request.conversation_id,
+                "keyword": request.keyword,
+                "situation": current_situation
+            }
+        }
+
+        return StreamingResponse(
+            stream_chat_events(http_request, chat_chain, request.question, config, request.character_id, analyze=False),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 tts = TTS(language="ko")
 
+async def speak_chat_events(http_request: Request, chat_chain, question: str, config: dict, character_id: int):
+    """
+    LLM 토큰과 음성을 하나의 SSE 스트림으로 전달
+    문장이 완성될 때마다 바로 TTS 합성을 시작하고, 합성된 음성은 문장 순서대로 base64 로 보낸다.
+    """
+    events = asyncio.Queue()
+    segments = asyncio.Queue()      # (문장, 합성 task), 생성이 끝나면 None
+    synth_tasks = []
+    semaphore = asyncio.Semaphore(TTS_CHUNK_CONCURRENCY)
+
+    async def synthesize(text: str) -> bytes:
+        async with semaphore:
+            return await tts.synthesize(text)
+
+    def dispatch(text: str):
+        task = asyncio.create_task(synthesize(text))
+        synth_tasks.append(task)
+        segments.put_nowait((text, task))
+
+    async def produce_text():
+        stream = chat_chain.astream({"question": question}, config)
+        answer = ""
+        buffer = ""
+        try:
+            async for token in stream:
+                answer += token
+                buffer += token
+                await events.put(sse_event("token", {"token": token}))
+
+                segment, buffer = tts.take_segment(buffer)
+                if segment:
+                    dispatch(segment)
+
+            segment, _ = tts.take_segment(buffer, final=True)
+            if segment:
+                dispatch(segment)
+            return answer
+        except Exception as e:
+            await events.put(sse_event("error", {"detail": str(e)}))
+            raise
+        finally:
+            segments.put_nowait(None)
+            await stream.aclose()
+            await events.put(None)
+
+    async def produce_audio():
+        seq = 0
+        try:
+            while True:
+                item = await segments.get()
+                if item is None:
+                    return
+                text, task = item
+                try:
+                    audio = await task
+                    await events.put(sse_event("audio", {
+                        "seq": seq,
+                        "text": text,
+                        "audio": base64.b64encode(audio).decode("ascii")
+                    }))
+                except Exception as e:
+                    await events.put(sse_event("audio_error", {"seq": seq, "text": text, "detail": str(e)}))
+                seq += 1
+        finally:
+            await events.put(None)
+
+    text_task = asyncio.create_task(produce_text())
+    audio_task = asyncio.create_task(produce_audio())
+    try:
+        finished = 0
+        while finished < 2:
+            event = await events.get()
+            if event is None:
+                finished += 1
+                continue
+            if await http_request.is_disconnected():
+                print("클라이언트 연결이 끊어져 음성 스트리밍을 중단합니다. character_id:", character_id)
+                return
+            yield event
+
+        if not text_task.cancelled() and text_task.exception() is None:
+            answer = text_task.result()
+            msg_img = classify_emotion(answer)
+            emotion_ticket = refine_emotion(answer, msg_img, analyze_emotion)
+            yield sse_event("done", {"answer": answer, "character_id": character_id, "msg_img": msg_img, "emotion_ticket": emotion_ticket})
+    finally:
+        # 연결이 끊기면 LLM 스트림과 남은 TTS 합성을 모두 취소
+        for task in [text_task, audio_task, *synth_tasks]:
+            task.cancel()
+
+# 캐릭터와 채팅 + 음성 (토큰과 문장별 음성을 하나의 SSE 스트림으로)
+@app.post("/chat/speak")
+async def chat_speak(request: ChatRequest, http_request: Request):
+    try:
+        await wait_for_character(request.character_id)
+        chat_chain = get_chat_chain(request.character_id)
+
+        config = {
+            "configurable": {
+                "user_id": request.user_id,
+                "conversation_id": request.conversation_id
+            }
+        }
+
+        return StreamingResponse(
+            speak_chat_events(http_request, chat_chain, request.question, config, request.character_id),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.get("/chat/stream_audio")
-async def stream_audio(text: str = Query(..., description="음성을 생성할 텍스트")):
+async def stream_audio(
+    http_request: Request,
+    text: str = Query(..., description="음성을 생성할 텍스트"),
+    chunked: bool = Query(False, description="문장 단위로 나눠 동시에 합성하고 순서대로 스트리밍")
+):
     """
     텍스트를 받아 음성을 반환하는 API 엔드포인트
     :param text: 음성을 생성할 텍스트
+    :param chunked: 문장 단위 분할 합성 여부 (긴 답변의 첫 재생까지 걸리는 시간 단축)
     :return: StreamingResponse
     """
     try:
-        return tts.generate_audio(text)
+        if chunked:
+            return await tts.generate_audio_chunked(text)
+        return await tts.generate_audio(
+            text,
+            range_header=http_request.headers.get("range"),
+            if_none_match=http_request.headers.get("if-none-match")
+        )
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
@@ -22,14 +22,25 @@ class CharacterMatchRequest(BaseModel):
     char_id_list: List[int]
     chat_history_list: List[str] = []
 
+# 단체방 채팅 request 모델 (매칭 + 선택된 캐릭터 동시 응답)
+class GroupChatRequest(BaseModel):
+    user_id: int
+    conversation_id: int
+    question: str
+    char_id_list: List[int]
+    chat_history_list: List[str] = []
+
 class LoadInfoRequest(BaseModel):
     char_id_list: List[int]
 
 class CharacterMatchResponse(BaseModel):
     selected_char_id_list: List[int]
+    confidence: Optional[float] = None  # 선택된 캐릭터와 나머지 캐릭터의 점수 차이 (0~1)
+    method: Optional[str] = None        # name | embedding | llm
 
 # /chat response 모델
 class ChatResponse(BaseModel):
     answer: str
     character_id: int
-    msg_img: Optional[int] = None
\ No newline at end of file
+    msg_img: Optional[int] = None
+    emotion_ticket: Optional[str] = None    # LLM 감정 분석 보정 결과 조회용 (/chat/emotion/{ticket})
\ No newline at end of file
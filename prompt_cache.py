@@ -0,0 +1,135 @@
+import os
+import threading
+from typing import Any, Optional
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.prompts.chat import SystemMessagePromptTemplate
+
+# 요청마다 바뀌는 값은 페르소나 시스템 메세지에서 빼서 뒤쪽으로 옮김 (OpenAI 프롬프트 캐시가 앞부분 일치로 동작하기 때문)
+PROMPT_PREFIX_CACHE = os.getenv("PROMPT_PREFIX_CACHE", "true").lower() == "true"
+
+# 요청마다 캐시된/캐시되지 않은 프롬프트 토큰 수 출력 여부
+PROMPT_CACHE_LOG = os.getenv("PROMPT_CACHE_LOG", "false").lower() == "true"
+
+# 요청마다 바뀌는 프롬프트 변수
+DYNAMIC_VARIABLES = ("relevant_info", "situation")
+
+
+def _split_template(template: str):
+    static, dynamic = [], []
+    for line in template.split("\n"):
+        if not any(f"{{{name}}}" in line for name in DYNAMIC_VARIABLES):
+            static.append(line)
+            continue
+        if line.strip() in {f"{{{name}}}" for name in DYNAMIC_VARIABLES}:
+            # "# Context" 처럼 변수만 담고 있던 제목은 함께 옮김
+            while static and not static[-1].strip():
+                static.pop()
+            if static and static[-1].strip().startswith("#"):
+                dynamic.append(static.pop().strip())
+        dynamic.append(line.strip())
+    return "\n".join(static), dynamic
+
+
+def cache_friendly_prompt(prompt: ChatPromptTemplate) -> ChatPromptTemplate:
+    """
+    페르소나 시스템 메세지는 요청과 상관없이 항상 같은 문자열이 되도록 relevant_info / situation 줄을 빼고,
+    [페르소나] [대화 히스토리] [이번 요청 컨텍스트] [질문] 순서로 다시 구성
+    같은 캐릭터의 요청끼리는 페르소나까지, 같은 대화의 다음 턴은 히스토리까지 앞부분이 같아져서 캐시에 적중한다.
+    """
+    if not PROMPT_PREFIX_CACHE:
+        return prompt
+
+    messages = []
+    context_lines = []
+    history_index = None
+    for message in prompt.messages:
+        if isinstance(message, SystemMessagePromptTemplate) and isinstance(getattr(message.prompt, "template", None), str):
+            static, dynamic = _split_template(message.prompt.template)
+            if dynamic:
+                context_lines.extend(dynamic)
+                message = SystemMessagePromptTemplate.from_template(static)
+        if isinstance(message, MessagesPlaceholder):
+            history_index = len(messages)
+        messages.append(message)
+
+    if not context_lines:
+        return prompt
+
+    if not context_lines[0].startswith("#"):
+        context_lines.insert(0, "# Request Context")
+    context = SystemMessagePromptTemplate.from_template("\n".join(context_lines))
+
+    # 히스토리 바로 뒤 (히스토리가 없으면 마지막 질문 앞)
+    insert_at = history_index + 1 if history_index is not None else len(messages) - 1
+    messages.insert(insert_at, context)
+    return ChatPromptTemplate.from_messages(messages)
+
+
+class PromptCacheStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._characters = {}   # character_id -> [요청 수, 프롬프트 토큰, 캐시된 토큰]
+
+    def record(self, character_id: int, prompt_tokens: int, cached_tokens: int):
+        with self._lock:
+            entry = self._characters.setdefault(character_id, [0, 0, 0])
+            entry[0] += 1
+            entry[1] += prompt_tokens
+            entry[2] += cached_tokens
+
+    def stats(self) -> dict:
+        with self._lock:
+            characters = {
+                character_id: {
+                    "requests": requests,
+                    "prompt_tokens": prompt_tokens,
+                    "cached_tokens": cached_tokens,
+                    "uncached_tokens": prompt_tokens - cached_tokens,
+                    "cached_ratio": round(cached_tokens / prompt_tokens, 4) if prompt_tokens else 0.0
+                }
+                for character_id, (requests, prompt_tokens, cached_tokens) in self._characters.items()
+            }
+        return {"layout": "prefix_cache" if PROMPT_PREFIX_CACHE else "original", "characters": characters}
+
+
+prompt_cache_stats = PromptCacheStats()
+
+
+def _usage_from_result(response: LLMResult) -> Optional[tuple]:
+    # 스트리밍(stream_usage=True)/일반 호출 모두 message.usage_metadata 에 들어 있음
+    for generations in response.generations:
+        for generation in generations:
+            usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+            if usage:
+                details = usage.get("input_token_details") or {}
+                return usage.get("input_tokens", 0), details.get("cache_read", 0) or 0
+
+    # 이전 버전 호환: llm_output 의 token_usage
+    token_usage = (response.llm_output or {}).get("token_usage") or {}
+    if token_usage:
+        details = token_usage.get("prompt_tokens_details") or {}
+        return token_usage.get("prompt_tokens", 0), details.get("cached_tokens", 0) or 0
+    return None
+
+
+class PromptCacheUsageHandler(BaseCallbackHandler):
+    """
+    캐릭터 LLM 호출마다 프롬프트 토큰 중 캐시된 토큰 수를 기록
+    """
+
+    run_inline = True
+
+    def __init__(self, character_id: int):
+        self.character_id = character_id
+
+    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        usage = _usage_from_result(response)
+        if usage is None:
+            return
+        prompt_tokens, cached_tokens = usage
+        prompt_cache_stats.record(self.character_id, prompt_tokens, cached_tokens)
+        if PROMPT_CACHE_LOG:
+            print(f"캐릭터 id: {self.character_id} 프롬프트 토큰 {prompt_tokens} (캐시 {cached_tokens}, 비캐시 {prompt_tokens - cached_tokens})")
@@ -0,0 +1,193 @@
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import numpy as np
+from langchain_core.documents import Document
+
+# 캐릭터별 검색 결과 캐시 크기와 유지 시간(초)
+RETRIEVAL_CACHE_SIZE = int(os.getenv("RETRIEVAL_CACHE_SIZE", "256"))
+RETRIEVAL_CACHE_TTL = float(os.getenv("RETRIEVAL_CACHE_TTL", "600"))
+
+# 문장이 달라도 질문 임베딩이 충분히 가까우면 캐시된 결과를 재사용 (질문 임베딩 호출은 필요)
+RETRIEVAL_CACHE_SEMANTIC = os.getenv("RETRIEVAL_CACHE_SEMANTIC", "false").lower() == "true"
+RETRIEVAL_CACHE_SEMANTIC_THRESHOLD = float(os.getenv("RETRIEVAL_CACHE_SEMANTIC_THRESHOLD", "0.97"))
+
+_WHITESPACE_PATTERN = re.compile(r"\s+")
+_TRAILING_PUNCTUATION_PATTERN = re.compile(r"[\s?!.~,…]+$")
+
+
+def normalize_question(question: str) -> str:
+    """
+    "넌 누구야?", "넌  누구야??" 처럼 공백/대소문자/끝 문장부호만 다른 질문을 같은 키로 취급
+    """
+    text = unicodedata.normalize("NFKC", question or "").lower().strip()
+    text = _WHITESPACE_PATTERN.sub(" ", text)
+    return _TRAILING_PUNCTUATION_PATTERN.sub("", text)
+
+
+def _normalize_vector(vector) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def _uses_vector(retriever) -> bool:
+    # lexical 모드의 HybridRetriever 는 질문 임베딩이 필요 없음
+    needs_query_vector = getattr(retriever, "needs_query_vector", None)
+    return needs_query_vector() if needs_query_vector else True
+
+
+def _search_by_vector(retriever, question: str, query_vector) -> List[Document]:
+    if hasattr(retriever, "search_by_vector"):
+        return retriever.search_by_vector(question, query_vector)
+    return retriever.vectorstore.similarity_search_by_vector(list(query_vector), **retriever.search_kwargs)
+
+
+async def _asearch_by_vector(retriever, question: str, query_vector) -> List[Document]:
+    if hasattr(retriever, "asearch_by_vector"):
+        return await retriever.asearch_by_vector(question, query_vector)
+    return await retriever.vectorstore.asimilarity_search_by_vector(list(query_vector), **retriever.search_kwargs)
+
+
+class _Entry:
+    __slots__ = ("expires_at", "store_id", "docs", "vector")
+
+    def __init__(self, expires_at: float, store_id: int, docs: List[Document], vector: Optional[np.ndarray]):
+        self.expires_at = expires_at
+        self.store_id = store_id
+        self.docs = docs
+        self.vector = vector
+
+
+class RetrievalCache:
+    """
+    캐릭터별 검색 결과 LRU + TTL 캐시 (키: 정규화된 질문)
+    캐시된 결과는 만들 때 사용한 vectorstore 를 기억하고 있어서, 인덱스가 다시 만들어지면 더 이상 쓰이지 않는다.
+    """
+
+    def __init__(self, embeddings, max_size: int = RETRIEVAL_CACHE_SIZE, ttl: float = RETRIEVAL_CACHE_TTL,
+                 semantic: bool = RETRIEVAL_CACHE_SEMANTIC, semantic_threshold: float = RETRIEVAL_CACHE_SEMANTIC_THRESHOLD):
+        self.embeddings = embeddings
+        self.max_size = max_size
+        self.ttl = ttl
+        self.semantic = semantic
+        self.semantic_threshold = semantic_threshold
+        self._entries: Dict[int, OrderedDict] = {}     # character_id -> (정규화된 질문 -> _Entry)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def invalidate(self, character_id: int):
+        with self._lock:
+            if self._entries.pop(character_id, None):
+                self.invalidations += 1
+
+    def _lookup(self, character_id: int, key: str, store_id: int) -> Optional[List[Document]]:
+        with self._lock:
+            entries = self._entries.get(character_id)
+            entry = entries.get(key) if entries else None
+            if entry is None:
+                return None
+            if entry.expires_at < time.monotonic() or entry.store_id != store_id:
+                del entries[key]
+                return None
+            entries.move_to_end(key)
+            self.hits += 1
+            return list(entry.docs)
+
+    def _lookup_semantic(self, character_id: int, vector: np.ndarray, store_id: int) -> Optional[List[Document]]:
+        with self._lock:
+            entries = self._entries.get(character_id)
+            if not entries:
+                return None
+            now = time.monotonic()
+            candidates = [(key, entry) for key, entry in entries.items()
+                          if entry.vector is not None and entry.expires_at >= now and entry.store_id == store_id]
+            if not candidates:
+                return None
+            similarities = np.stack([entry.vector for _, entry in candidates]) @ vector
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.semantic_threshold:
+                return None
+            key, entry = candidates[best]
+            entries.move_to_end(key)
+            self.semantic_hits += 1
+            return list(entry.docs)
+
+    def _store(self, character_id: int, key: str, store_id: int, docs: List[Document], vector: Optional[np.ndarray]):
+        with self._lock:
+            self.misses += 1
+            entries = self._entries.setdefault(character_id, OrderedDict())
+            entries[key] = _Entry(time.monotonic() + self.ttl, store_id, list(docs), vector)
+            entries.move_to_end(key)
+            while len(entries) > self.max_size:
+                entries.popitem(last=False)
+
+    def retrieve(self, character_id: int, retriever, question: str) -> List[Document]:
+        key = normalize_question(question)
+        vectorstore = retriever.vectorstore
+        docs = self._lookup(character_id, key, id(vectorstore))
+        if docs is not None:
+            return docs
+
+        if not (self.semantic and _uses_vector(retriever)):
+            docs = retriever.invoke(question)
+            self._store(character_id, key, id(vectorstore), docs, None)
+            return docs
+
+        # 임베딩은 한 번만 계산해서 유사 질문 조회와 검색에 함께 사용
+        query_vector = self.embeddings.embed_query(question)
+        vector = _normalize_vector(query_vector)
+        docs = self._lookup_semantic(character_id, vector, id(vectorstore))
+        if docs is not None:
+            return docs
+        docs = _search_by_vector(retriever, question, query_vector)
+        self._store(character_id, key, id(vectorstore), docs, vector)
+        return docs
+
+    async def aretrieve(self, character_id: int, retriever, question: str, query_vector=None) -> List[Document]:
+        """
+        :param query_vector: 이미 계산된 질문 임베딩 (있으면 임베딩 호출 없이 검색)
+        """
+        key = normalize_question(question)
+        vectorstore = retriever.vectorstore
+        docs = self._lookup(character_id, key, id(vectorstore))
+        if docs is not None:
+            return docs
+
+        semantic = self.semantic and _uses_vector(retriever)
+        if not semantic and query_vector is None:
+            docs = await retriever.ainvoke(question)
+            self._store(character_id, key, id(vectorstore), docs, None)
+            return docs
+
+        if query_vector is None:
+            query_vector = await self.embeddings.aembed_query(question)
+        vector = _normalize_vector(query_vector)
+        if semantic:
+            docs = self._lookup_semantic(character_id, vector, id(vectorstore))
+            if docs is not None:
+                return docs
+        docs = await _asearch_by_vector(retriever, question, query_vector)
+        self._store(character_id, key, id(vectorstore), docs, vector if semantic else None)
+        return docs
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.semantic_hits + self.misses
+        with self._lock:
+            size = sum(len(entries) for entries in self._entries.values())
+        return {
+            "hits": self.hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.semantic_hits) / lookups if lookups else 0.0,
+            "invalidations": self.invalidations,
+            "size": size
+        }
@@ -0,0 +1,115 @@
+import os
+import re
+import threading
+from collections import Counter
+from typing import Tuple
+
+from retrieval_cache import normalize_question
+
+# 인사/맞장구 같은 잡담은 캐릭터 지식 검색을 건너뜀
+RETRIEVAL_GATE = os.getenv("RETRIEVAL_GATE", "true").lower() == "true"
+
+# 검색 여부 판단 결과 출력 여부 (질문 내용은 출력하지 않음)
+RETRIEVAL_GATE_LOG = os.getenv("RETRIEVAL_GATE_LOG", "false").lower() == "true"
+
+# 이 글자 수 이하의 짧은 말은 잡담 단어로만 이루어져 있으면 검색하지 않음
+RETRIEVAL_GATE_SHORT_CHARS = int(os.getenv("RETRIEVAL_GATE_SHORT_CHARS", "12"))
+
+SMALL_TALK_WORDS = {
+    "안녕", "안녕하세요", "안뇽", "하이", "헬로", "hi", "hello", "hey", "ㅎㅇ", "반가워", "반가워요", "반갑다", "반갑습니다",
+    "고마워", "고마워요", "고맙다", "고맙습니다", "감사", "감사해", "감사해요", "감사합니다", "땡큐", "thanks", "thank you",
+    "응", "웅", "엉", "어", "네", "넹", "예", "아니", "아니야", "아냐", "그래", "그래요", "그렇구나", "그렇군", "그치", "맞아", "맞아요",
+    "좋아", "좋아요", "좋다", "오케이", "ok", "okay", "굿", "최고", "대박", "와", "우와", "오", "헐", "ㄱㄱ", "ㅇㅇ", "ㅇㅋ",
+    "잘자", "잘 자", "굿밤", "잘가", "잘 가", "바이", "bye", "또 봐", "다음에 봐", "미안", "미안해", "죄송해요", "괜찮아",
+    "ㅋㅋ", "ㅎㅎ", "ㅠㅠ", "ㅜㅜ", "하하", "히히", "호호", "헤헤", "크크",
+}
+
+# normalize_question 은 NFKC 정규화로 "ㅋ" 같은 호환 자모를 첫가끝 자모로 바꾸므로 비교할 단어도 같은 방식으로 정규화
+SMALL_TALK_WORDS = {normalize_question(word) for word in SMALL_TALK_WORDS}
+
+# 이런 표현이 있으면 짧아도 지식 검색이 필요한 질문으로 봄
+KNOWLEDGE_CUES = (
+    "누구", "뭐", "무엇", "어디", "언제", "왜", "어떻게", "어떤", "몇", "얼마", "알려", "설명", "얘기", "이야기", "기억", "사건", "비밀",
+    "who", "what", "where", "when", "why", "how",
+)
+
+# 자모/이모티콘/문장부호만으로 된 말 (예: "ㅋㅋㅋ", "ㅠㅠ", "^^", "!!")
+_REACTION_CHARS = r"ㄱ-ㅎㅏ-ㅣ\u1100-\u11ff^~!?.,…♡♥❤\U0001F300-\U0001FAFF"
+_REACTION_ONLY_PATTERN = re.compile(rf"^[\s{_REACTION_CHARS}]*$")
+_TRAILING_REACTION_PATTERN = re.compile(rf"[{_REACTION_CHARS}]+$")
+_REPEAT_PATTERN = re.compile(r"(.)\1{2,}")
+
+
+def needs_retrieval(question: str) -> Tuple[bool, str]:
+    """
+    질문에 캐릭터 지식 검색이 필요한지 판단 (LLM/임베딩 호출 없는 규칙 기반)
+    :return: (검색 여부, 판단 이유)
+    """
+    text = normalize_question(question)
+    if not text or _REACTION_ONLY_PATTERN.match(text):
+        return False, "reaction"
+
+    if any(cue in text for cue in KNOWLEDGE_CUES):
+        return True, "knowledge_cue"
+
+    # "안녕ㅋㅋㅋ" -> "안녕ㅋㅋ" 처럼 반복 글자를 줄이고 자모/이모티콘을 떼어 낸 뒤 잡담 단어인지 확인
+    compact = _REPEAT_PATTERN.sub(r"\1\1", text)
+    core = _TRAILING_REACTION_PATTERN.sub("", compact).strip()
+    if compact in SMALL_TALK_WORDS or core in SMALL_TALK_WORDS:
+        return False, "small_talk"
+
+    if len(text) <= RETRIEVAL_GATE_SHORT_CHARS:
+        words = core.split()
+        if words and all(word in SMALL_TALK_WORDS for word in words):
+            return False, "small_talk"
+
+    return True, "default"
+
+
+class RetrievalGate:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checked = 0
+        self.skipped = 0
+        self.reasons = Counter()
+        self.retrievals = 0
+        self.retrieval_seconds = 0.0
+
+    def check(self, character_id: int, question: str) -> bool:
+        """
+        :return: 검색을 해야 하면 True
+        """
+        if not RETRIEVAL_GATE:
+            return True
+
+        retrieve, reason = needs_retrieval(question)
+        with self._lock:
+            self.checked += 1
+            self.reasons[reason] += 1
+            if not retrieve:
+                self.skipped += 1
+        if RETRIEVAL_GATE_LOG:
+            print(f"캐릭터 id: {character_id} 검색 {'수행' if retrieve else '생략'} ({reason})")
+        return retrieve
+
+    def record_retrieval(self, seconds: float):
+        # 실제 검색에 걸린 시간 (생략으로 아낀 시간 추정에 사용)
+        with self._lock:
+            self.retrievals += 1
+            self.retrieval_seconds += seconds
+
+    def stats(self) -> dict:
+        with self._lock:
+            avg_retrieval = self.retrieval_seconds / self.retrievals if self.retrievals else 0.0
+            return {
+                "enabled": RETRIEVAL_GATE,
+                "checked": self.checked,
+                "skipped": self.skipped,
+                "skip_rate": round(self.skipped / self.checked, 4) if self.checked else 0.0,
+                "reasons": dict(self.reasons),
+                "avg_retrieval_ms": round(avg_retrieval * 1000, 2),
+                "estimated_saved_ms": round(self.skipped * avg_retrieval * 1000, 1)
+            }
+
+
+retrieval_gate = RetrievalGate()
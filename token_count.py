@@ -0,0 +1,19 @@
+try:
+    import tiktoken
+    # gpt-4o / gpt-4o-mini 계열 토크나이저
+    _ENCODING = tiktoken.get_encoding("o200k_base")
+except Exception:
+    _ENCODING = None
+
+
+def count_tokens(text: str) -> int:
+    """
+    텍스트의 토큰 수 계산 (tiktoken 을 쓸 수 없으면 글자 수로 대략 추정)
+    :param text: 토큰 수를 셀 텍스트
+    :return: 토큰 수
+    """
+    if not text:
+        return 0
+    if _ENCODING is not None:
+        return len(_ENCODING.encode(text))
+    return max(1, len(text) // 2)